@@ -19,23 +19,38 @@
 #  * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import sys
+import io
+import os
+import re
+import hashlib
+import json
+import stat
+import socket
+import marshal
+import pickle
+import gc
+import operator
 from fractions import Fraction
 from decimal import Decimal
 
+version_global='1.9' # also keys the --cache-dir files
 isdebug_global=False
 
 allcommands_global={'join','variable','map','unmap''global0','globalint','globalstring',
 		'name','include','suppress','unsuppress','adopt','set','setstring','unset','sum','printvar','assert'}
+boundcommands_global={'variable','unmap','include','suppress','unsuppress', # these get resolved in place by prebuild/postbuild
+		'set','setstring','unset','sum','printvar','assert'}
+framecommands_global={'include','variable','unmap','suppress','unsuppress'} # Node.export() handles these itself, the rest go to PreOutput.command()
+
+uidkey_global=operator.attrgetter('uid')
+
+class MsetError(Exception): pass # main() prints these and exits
 
 def errorout(desc):
-	if isdebug_global: raise Exception('Error: %s'%desc)
-	print('Error: %s'%desc)
-	exit(-1)
+	raise MsetError('Error: %s'%desc)
 def node_errorout(node,desc):
 	if not node: errorout(desc)
-	if isdebug_global: raise Exception('Error in node: %s, node: %s'%(desc,node.orig_lines))
-	print('Error: (%s), in node: %s'%(desc,node.orig_lines))
-	exit(-1)
+	raise MsetError('Error: (%s), in node: %s'%(desc,node.orig_lines))
 
 class GlobalVars():
 	def __init__(self):
@@ -75,6 +90,15 @@ class GlobalVars():
 		errorout('Globalvars: name "%s" has unknown type "%s"'%(name,type(v)))
 
 class Phase0():
+	class Lines(): # source lines of a chunk, as offsets into the file buffer, only copied out for messages
+		def __init__(self,buf,spans):
+			self.buf=buf
+			self.spans=spans # [start0,end0,start1,end1,...]
+		def getlines(self):
+			spans=self.spans
+			return [self.buf[spans[i]:spans[i+1]] for i in range(0,len(spans),2)]
+		def __bool__(self): return len(self.spans)!=0
+		def __repr__(self): return repr(self.getlines())
 	class Chunk():
 		def __init__(self,words,lines):
 			self.isactive=True
@@ -91,113 +115,99 @@ class Phase0():
 				elif w.startswith('._name('): self.names.append(w[8:-1].trim())
 				elif w.startswith('.='): self.names.append(w[2:])
 	
-	def finddotlength(l_in): # assumes l starts with .
-		if len(l_in)==1: return 1
-		if l_in[1]=='#': return len(l_in)
-		ret=1
-		l=l_in[1:]
+	def finddotlength(l,i=0,n=None): # assumes l[i] is ., returns length of the dot word in l[i:n]
+		if n==None: n=len(l)
+		k=i+1
+		if k==n: return 1
+		if l[k]=='#': return n-i
 		pcount=0
 		while True:
-			if not l:
-				if pcount: raise ValueError("Unmatch parenthesis in %s",l_in)
-				return ret
-			c=l[0]
+			if k>=n:
+				if pcount: raise ValueError("Unmatch parenthesis in %s",l[i:])
+				return k-i
+			c=l[k]
 			if not pcount:
-				if c in (' ','\t','\\'): return ret
+				if c in (' ','\t','\\'): return k-i
 			if c=='\\':
-				if l[1] in ('(',')',):
-					ret+=2
-					l=l[2:]
+				if k+1<n and l[k+1] in ('(',')',): k+=2
 			elif c=='(': pcount+=1
 			elif c==')': pcount-=1
-			ret+=1
-			l=l[1:]
+			k+=1
+
+	escapes_re=re.compile('n|space|s|tab|t|bs|backspace|br|bold|b|Bold|B|italic|i|Italic|I|paragraph|p|Paragraph|P|underline|u|Underline|U')
+	escapes_names={'n':'\\n','space':'\\space','s':'\\space','tab':'\\t','t':'\\t','bs':'\\backspace','backspace':'\\backspace',
+			'br':'\\br','bold':'\\bold','b':'\\bold','Bold':'\\Bold','B':'\\Bold','italic':'\\italic','i':'\\italic',
+			'Italic':'\\Italic','I':'\\Italic','paragraph':'\\paragraph','p':'\\paragraph','Paragraph':'\\Paragraph','P':'\\Paragraph',
+			'underline':'\\underline','u':'\\underline','Underline':'\\Underline','U':'\\Underline'}
+	space_re=re.compile('[ \t]')
+	spaceorescape_re=re.compile('[ \t\\\\]')
 
-	def findwordlength(l):
-		for i,c in enumerate(l):
-			if c==' ' or c=='\t': return i
-		return len(l)
+	def findwordend(l,i,n): # index of the first space or tab in l[i:n], or n
+		m=Phase0.space_re.search(l,i,n)
+		if m: return m.start()
+		return n
 
-	def parseline(l):
+	def parseline(l,i=0,n=None): # parses l[i:n] without copying it
 		dest=[]
 		inescape=False
-		while True:
-			if not l: break
-			c=l[0]
+		if n==None: n=len(l)
+		while i<n:
+			c=l[i]
 			if c==' ' or c=='\t':
-				l=l[1:]
+				i+=1
 				inescape=False
 				continue
 			if c=='.':
-				j=Phase0.finddotlength(l)
-				w=l[:j]
+				j=Phase0.finddotlength(l,i,n)
+				w=l[i:i+j]
 				if w=='.': dest.append('.')
 				elif w[1]=='#': break # ignore rest of line
 				else: dest.append(w)
-				l=l[j+1:]
+				i+=j+1
 				continue
 			if c=='\\':
-				if l.startswith('\\\\') or l.startswith('\\.'): 
-					j=Phase0.findwordlength(l)
-					dest.append(l[:j])
-					l=l[j+1:]
+				if l.startswith(('\\\\','\\.'),i,n):
+					j=Phase0.findwordend(l,i,n)
+					dest.append(l[i:j])
+					i=j+1
 					continue
 				inescape=True
-				l=l[1:]
-				if l.startswith('n'): dest.append('\\n') ; l=l[1:]
-				elif l.startswith('space'): dest.append('\\space') ; l=l[5:]
-				elif l.startswith('s'): dest.append('\\space') ; l=l[1:]
-				elif l.startswith('tab'): dest.append('\\t') ; l=l[3:]
-				elif l.startswith('t'): dest.append('\\t') ; l=l[1:]
-				elif l.startswith('bs'): dest.append('\\backspace') ; l=l[2:]
-				elif l.startswith('backspace'): dest.append('\\backspace') ; l=l[9:]
-				elif l.startswith('br'): dest.append('\\br') ; l=l[2:]
-				elif l.startswith('bold'): dest.append('\\bold') ; l=l[4:]
-				elif l.startswith('b'): dest.append('\\bold') ; l=l[1:]
-				elif l.startswith('Bold'): dest.append('\\Bold') ; l=l[4:]
-				elif l.startswith('B'): dest.append('\\Bold') ; l=l[1:]
-				elif l.startswith('italic'): dest.append('\\italic') ; l=l[6:]
-				elif l.startswith('i'): dest.append('\\italic') ; l=l[1:]
-				elif l.startswith('Italic'): dest.append('\\Italic') ; l=l[6:]
-				elif l.startswith('I'): dest.append('\\Italic') ; l=l[1:]
-				elif l.startswith('paragraph'): dest.append('\\paragraph') ; l=l[9:]
-				elif l.startswith('p'): dest.append('\\paragraph') ; l=l[1:]
-				elif l.startswith('Paragraph'): dest.append('\\Paragraph') ; l=l[9:]
-				elif l.startswith('P'): dest.append('\\Paragraph') ; l=l[1:]
-				elif l.startswith('underline'): dest.append('\\underline') ; l=l[9:]
-				elif l.startswith('u'): dest.append('\\underline') ; l=l[1:]
-				elif l.startswith('Underline'): dest.append('\\Underline') ; l=l[9:]
-				elif l.startswith('U'): dest.append('\\Underline') ; l=l[1:]
+				i+=1
+				m=Phase0.escapes_re.match(l,i,n)
+				if m:
+					dest.append(Phase0.escapes_names[m.group()])
+					i=m.end()
 				continue
 			if inescape:
-				for i,c in enumerate(l):
-					if c=='\\':
-						dest.append(l[:i])
-						l=l[i:]
-						break
-					if c==' ' or c=='\t':
-						inescape=False
-						dest.append(l[:i])
-						l=l[i:]
-						break
-				else:
-					dest.append(l)
+				m=Phase0.spaceorescape_re.search(l,i,n)
+				if not m:
+					dest.append(l[i:n])
 					break
+				j=m.start()
+				if l[j]!='\\': inescape=False
+				dest.append(l[i:j])
+				i=j
 				continue
 
-			j=Phase0.findwordlength(l)
-			dest.append(l[:j])
-			l=l[j+1:]
+			j=Phase0.findwordend(l,i,n)
+			dest.append(l[i:j])
+			i=j+1
 		return dest
 
 	def __init__(self):
 		self.chunks=[]
 		self.globalvars=GlobalVars()
+		self.cachedir=None # if set, phase0 chunks are cached here by file hash
+		self.filehashes=[] # content hash of each input, in order
 	def dump(self):
 		for chunk in self.chunks:
 			print("Chunk: %s"%(chunk.isactive))
 			for i,c in enumerate(chunk.words):
 				print('%s: %s'%(i,c))
+	def setvarname(text): # the variable a ._global command sets
+		param=text[text.find('(')+1:-1]
+		if text.startswith('._global0('): return param.strip() # the name can have commas
+		return param.split(',')[0].strip()
 	def setvarcmd(self,text):
 		if text[-1]!=')': raise ValueError("bad close: %s"%text)
 		if text.startswith('._global0('):
@@ -217,74 +227,221 @@ class Phase0():
 			value=param[j+1:].strip()
 			self.globalvars.setvar(name,value)
 		else: raise ValueError("bad line: %s"%text)
-	def addfile(self,fn):
-		f=open(fn) if isinstance(fn,str) else fn
+	def splitchunks(buf,start=0,n=None): # returns [[words,spans],...] for the blank-line separated chunks in buf[start:n]
+		ret=[]
 		words=[]
-		lines=[]
-		while True:
-			l=f.readline()
-			if not l: break
-			if l[-1]!='\n': raise ValueError("unexpected eol")
-			l=l[:-1]
-			if l and l[-1]=='\r': l=l[:-1]
-			if not l:
+		spans=[]
+		if n==None: n=len(buf)
+		while start<n:
+			eol=buf.find('\n',start)
+			end=eol
+			if end>start and buf[end-1]=='\r': end-=1
+			if end==start:
 				if words:
-					self.chunks.append(Phase0.Chunk(words,lines))
+					ret.append([words,spans])
 					words=[]
-					lines=[]
+					spans=[]
+				start=eol+1
 				continue
-			if not words and l.startswith(('. ','.\t')):
-				l=l[2:]
-				words=Phase0.parseline(l)
+			if not words and buf.startswith(('. ','.\t'),start,end):
+				words=Phase0.parseline(buf,start+2,end)
 				if words:
-					self.chunks.append(Phase0.Chunk(words,[l]))
+					ret.append([words,[start+2,end]])
 					words=[]
-				continue
-			dest=Phase0.parseline(l)
-			if dest:
-				words.extend(dest)
-				lines.append(l)
+			else:
+				dest=Phase0.parseline(buf,start,end)
+				if dest:
+					words.extend(dest)
+					spans.append(start)
+					spans.append(end)
+			start=eol+1
 		if words:
-			self.chunks.append(Phase0.Chunk(words,lines))
-	def collectvars(self): # we first set vars from chunks with no requirements
+			ret.append([words,spans])
+		return ret
+	def setcachedir(self,dirname):
+		self.cachedir=dirname
+	def cachefilename(self,buf):
+		h=hashlib.sha256(version_global.encode())
+		h.update(buf.encode('utf-8','surrogatepass'))
+		digest=h.hexdigest()
+		self.filehashes.append(digest)
+		return os.path.join(self.cachedir,digest+'.p0')
+	def snapshotfilename(self): # call after .process, depends on every input, which chunks it kept and the resulting globalvars
+		h=hashlib.sha256(version_global.encode())
+		h.update(__name__.encode()) # pickles refer to classes by module
+		for digest in self.filehashes: h.update(digest.encode())
+		h.update(bytes(chunk.isactive for chunk in self.chunks)) # +vars can drop a chunk whose commands set the same vars anyway
+		h.update(repr(sorted(self.globalvars.vars.items())).encode('utf-8','surrogatepass'))
+		return os.path.join(self.cachedir,h.hexdigest()+'.nodes')
+	def loadcache(self,fn): # None unless fn holds [[words,spans],...] as savecache writes it
+		try:
+			with open(fn,'rb') as f: chunks=marshal.load(f)
+			if type(chunks) is not list: return None
+			for chunk in chunks:
+				if type(chunk) is not list or len(chunk)!=2: return None
+				(words,spans)=chunk
+				if type(words) is not list or type(spans) is not list or len(spans)&1: return None
+				''.join(words) # TypeError unless they're all strings
+				sum(map(operator.index,spans)) # and unless these are all ints
+		except (OSError,EOFError,ValueError,TypeError): return None
+		return chunks
+	def savecache(self,fn,chunks):
+		try:
+			os.makedirs(self.cachedir,exist_ok=True)
+			tmpfn='%s.%s'%(fn,os.getpid())
+			with open(tmpfn,'wb') as f: marshal.dump(chunks,f)
+			os.replace(tmpfn,fn)
+		except OSError: pass # the cache is only an optimization
+	def readfile(fn): # fn is a filename, '-' for stdin or a file object
+		if fn=='-': f=sys.stdin
+		elif isinstance(fn,str): f=open(fn)
+		else: f=fn
+		buf=f.read() # one bulk read, chunks keep offsets into buf
+		if f is not fn and f is not sys.stdin: f.close()
+		if buf and buf[-1]!='\n': raise ValueError("unexpected eol")
+		return buf
+	def parsebuf(self,buf): # returns [[words,spans],...], from the cache if possible
+		chunks=None
+		if self.cachedir:
+			cachefn=self.cachefilename(buf)
+			chunks=self.loadcache(cachefn)
+		if chunks==None:
+			chunks=Phase0.splitchunks(buf)
+			if self.cachedir: self.savecache(cachefn,chunks)
+		return chunks
+	def addchunks(self,buf,chunks):
+		for words,spans in chunks:
+			self.chunks.append(Phase0.Chunk(words,Phase0.Lines(buf,spans)))
+	def addfile(self,fn):
+		buf=Phase0.readfile(fn)
+		self.addchunks(buf,self.parsebuf(buf))
+	parallelbytes=1<<20 # less uncached input than this is tokenized faster in one process than by starting workers
+	blankline=re.compile(r'\n\r?\n')
+	def splitranges(buf,size): # [(start,end),...] of about size chars, each a run of whole chunks
+		ret=[]
+		start=0
+		n=len(buf)
+		while n-start>size:
+			m=Phase0.blankline.search(buf,start+size)
+			if not m: break
+			end=m.start()+1 # the blank line starts the next range
+			ret.append((start,end))
+			start=end
+		ret.append((start,n))
+		return ret
+	def splitparallel(bufs,todo,parsed,jobs,nbytes): # sets parsed[i] for i in todo, unless workers can't be forked
+		import multiprocessing,concurrent.futures # only loaded when needed, they're slow to import
+		if 'fork' not in multiprocessing.get_all_start_methods(): return # workers inherit bufs instead of being sent them
+		size=max(nbytes//(jobs*4),Phase0.parallelbytes//4) # a few ranges per worker evens out their load
+		tasks=[(i,start,end) for i in todo for start,end in Phase0.splitranges(bufs[i],size)]
+		global forkbufs_global
+		forkbufs_global=bufs
+		ctx=multiprocessing.get_context('fork')
+		try:
+			with concurrent.futures.ProcessPoolExecutor(min(jobs,len(tasks)),mp_context=ctx) as pool:
+				for (i,start,end),data in zip(tasks,pool.map(forked_splitchunks,tasks)):
+					if parsed[i]==None: parsed[i]=[]
+					parsed[i]+=marshal.loads(data) # in order, map keeps it
+		finally: forkbufs_global=None
+	def addfiles(self,fns,jobs=1): # like .addfile for each, but tokenizes uncached files in jobs processes when that's worth it
+		bufs=[Phase0.readfile(fn) for fn in fns]
+		parsed=[None]*len(bufs) # i -> [[words,spans],...]
+		cachefns=[None]*len(bufs)
+		if self.cachedir:
+			for i,buf in enumerate(bufs):
+				cachefns[i]=self.cachefilename(buf)
+				parsed[i]=self.loadcache(cachefns[i])
+		todo=[i for i in range(len(bufs)) if parsed[i]==None]
+		nbytes=sum(len(bufs[i]) for i in todo)
+		if jobs>1 and nbytes>=Phase0.parallelbytes:
+			cpus=cpucount()
+			if cpus>1: Phase0.splitparallel(bufs,todo,parsed,min(jobs,cpus),nbytes)
+		for i in todo:
+			if parsed[i]==None: parsed[i]=Phase0.splitchunks(bufs[i])
+			if self.cachedir: self.savecache(cachefns[i],parsed[i])
+		for buf,chunks in zip(bufs,parsed):
+			self.addchunks(buf,chunks)
+	def isrequired(self,word): # whether a .? word keeps its chunk
+		req=word[2:]
+		if req[0]=='-': return not self.globalvars.istrue(req[1:]) # .?-
+		if req[0]=='+': req=req[1:] # .?+
+		return self.globalvars.istrue(req) # .? or .?+
+	def isincluded(self,chunk): # by the global variables as they are now
 		gvv=self.globalvars.vars
-		for chunk in self.chunks:
-			if not chunk.isactive: continue
-			for name in chunk.names:
-				val=gvv.get(name,1)
-				if val==0:
-					chunk.isactive=False
-					break
-			else:
-				if chunk.requires: continue
-				for w in chunk.globalcmds:
-					self.setvarcmd(w)
-	def process(self):
+		for name in chunk.names:
+			if gvv.get(name,1)==0: return False
+		for word in chunk.requires:
+			if not self.isrequired(word): return False
+		return True
+	def process(self): # conditional inclusion, each chunk is decided once, after every chunk that sets a variable it depends on
+		chunks=[chunk for chunk in self.chunks if chunk.isactive and chunk.globalcmds] # only these can change another's decision
+		n=len(chunks)
+		order=[i for i in range(n) if not chunks[i].requires]+[i for i in range(n) if chunks[i].requires] # otherwise unconditional chunks set their variables first
+		pos=[0]*n # i -> index in order
+		for k,i in enumerate(order): pos[i]=k
+		sets=[{Phase0.setvarname(w) for w in chunk.globalcmds} for chunk in chunks] # i -> variables chunk i sets
+		setters={} # variable -> number of chunks setting it
+		for va in sets:
+			for name in va: setters[name]=setters.get(name,0)+1
+		readers={} # variable -> [i,...] of setting chunks it can exclude
+		waits=[0]*n # i -> chunks setting its variables that aren't decided yet
+		for i,chunk in enumerate(chunks):
+			for name in set(chunk.names+[word[3:] if word[2] in '+-' else word[2:] for word in chunk.requires]):
+				m=setters.get(name)
+				if not m: continue
+				readers.setdefault(name,[]).append(i)
+				waits[i]+=m-1 if name in sets[i] else m
+		isdecided=[False]*n
+		for isforced in (False,True): # the second pass breaks cycles in order
+			for k in range(n):
+				i=order[k]
+				if isdecided[i] or (waits[i] and not isforced): continue
+				todo=[i]
+				while todo:
+					i=todo.pop()
+					isdecided[i]=True
+					chunk=chunks[i]
+					if self.isincluded(chunk):
+						for w in chunk.globalcmds:
+							self.setvarcmd(w)
+					else: chunk.isactive=False
+					for name in sets[i]:
+						for j in readers.get(name,()):
+							if j==i: continue
+							waits[j]-=1
+							if not waits[j] and not isdecided[j] and pos[j]<k and not isforced: todo.append(j) # later ones are reached in order
 		gvv=self.globalvars.vars
+		isrequired={} # .? word -> whether it keeps its chunk, every variable is final now
 		for chunk in self.chunks:
-			if not chunk.isactive: continue
-			for name in chunk.names:
-				val=gvv.get(name,1)
-				if val==0:
+			if not chunk.isactive or chunk.globalcmds: continue
+			for word in chunk.requires:
+				v=isrequired.get(word)
+				if v==None: v=isrequired[word]=self.isrequired(word)
+				if not v:
 					chunk.isactive=False
 					break
 			else:
-				if not chunk.requires: continue # these are set in .collectvars
-				for word in chunk.requires:
-					req=word[2:]
-					if req[0]=='-': # .?-
-						req=req[1:]
-						if self.globalvars.istrue(req):
-							chunk.isactive=False
-							break
-					else: # .? or .?+
-						if req[0]=='+': req=req[1:] # .?+
-						if not self.globalvars.istrue(req):
-							chunk.isactive=False
-							break
-				if chunk.isactive:
-					for w in chunk.globalcmds:
-						self.setvarcmd(w)
+				for name in chunk.names:
+					if gvv.get(name,1)==0:
+						chunk.isactive=False
+						break
+
+def pathkey(params,globalvars): # hashable form of a parsed path with its variables filled in, None if it shouldn't be cached
+	key=[]
+	for p in params:
+		if p.text!=None: key.append(p.text)
+		elif p.cmd=='variable':
+			name=p.params[0].text
+			if name=='_uid': return None # different in every node, it would only fill the cache
+			value=globalvars.vars.get(name)
+			if value==None: return None # let findpath report it
+			key.append(('$',value))
+		elif p.cmd=='generate' or p.cmd=='path':
+			k=pathkey(p.params,globalvars)
+			if k==None: return None
+			key.append((p.cmd,k))
+		else: return None
+	return tuple(key)
 
 def parsenamestring(text,node):
 	n=len(text)
@@ -378,6 +535,9 @@ class Generation():
 		self.values=None # if we are an instance of (foo,bar), then we'll have [foo,bar] here
 		self.generator=None # Node, for generated, points to creator node
 		self.generateds={} # cname -> node, for generator
+		self.cmdindices=None # for generator, positions of the words that depend on variables, see compile()
+		self.nwords=0
+		self.plan=None # for generator, the render plan its generateds share, see Node.compileplan()
 	def clearparams(self):
 		self.params.clear()
 	def addparam(self,name):
@@ -386,6 +546,16 @@ class Generation():
 		self.generator=node
 	def setvalues(self,params):
 		self.values=params
+	def compile(self,words): # instantiation plan: bound words using variables are copied per generated, constant ones are shared and resolved once
+		self.cmdindices=[i for i,w in enumerate(words) if w.cmd in boundcommands_global and not w.isconstant()]
+		self.nwords=len(words)
+	def clonewords(self,words):
+		if self.cmdindices==None or self.nwords!=len(words): self.compile(words)
+		ret=words.copy()
+		for i in self.cmdindices: ret[i]=ret[i].bind()
+		return ret
+	def forget(self,uid): # shared words may have been resolved by a generated that is rolled back
+		for w in self.node.words: w.unbind(uid)
 	def setvars(self,globalvars):
 		gg=self.generator.generation
 		if not gg: node_errorout(self.generator,'Generation.setvars: generator without generation')
@@ -397,7 +567,12 @@ class Generation():
 		self.generateds[cname]=uid
 		
 				
-class Word():
+class WordType(type): # Word.escape and Word.node are constructors, w.escape and w.node are slots
+	escape=property(lambda cls: cls.escapeword)
+	node=property(lambda cls: cls.nodeword)
+
+class Word(metaclass=WordType):
+	__slots__=('orig','text','texts','escape','cmd','params','node','relt','nodes') # no per-word __dict__
 	def literal(text):
 		w=Word()
 		w.orig=text
@@ -409,12 +584,12 @@ class Word():
 		w.cmd=text
 		w.params=params
 		return w
-	def escape(text):
+	def escapeword(text):
 		w=Word()
 		w.orig=text
 		w.escape=text
 		return w
-	def node(node):
+	def nodeword(node):
 		w=Word()
 		w.orig='node'
 		w.node=node
@@ -442,7 +617,7 @@ class Word():
 		c=text[0]
 		if c=='$': return Word.command(text,'variable',[Word.literal(text[1:])])
 		if not c.isalnum(): node_errorout(caller,'Invalid name or unknown command: "%s"'%text)
-		return Word.literal(text)
+		return Word.literal(sys.intern(text)) # names are looked up over and over, share one string per name
 	def parseparam(text,caller): # may start with .
 		if len(text)<2: return Word.literal(text)
 		if text[0]=='(' and text[-1]==')': return Word.literal(text[1:-1])
@@ -537,20 +712,17 @@ class Word():
 		self.relt=None
 		self.nodes=None
 	def clone(self):
-		r=Word()
+		if self.cmd==None: return self # only command words get resolved in place, literals and escapes can be shared
+		r=Word.__new__(Word) # every slot is set below
 		r.orig=self.orig
 		r.text=self.text
-		if self.texts:
-			r.texts=self.texts.copy()
+		r.texts=self.texts.copy() if self.texts else None
 		r.escape=self.escape
 		r.cmd=self.cmd
-		if self.params:
-			r.params=[]
-			for w in self.params: r.params.append(w.clone())
+		r.params=[w.clone() for w in self.params] if self.params else None
 		r.node=self.node
 		r.relt=self.relt
-		if self.nodes:
-			r.nodes=self.nodes.copy()
+		r.nodes=self.nodes.copy() if self.nodes else None
 		return r
 	def __repr__(self):
 		if self.nodes: return 'nodes: %s'%self.nodes
@@ -569,52 +741,79 @@ class Word():
 			if w.text!=None: ret.append(w.text)
 			else: errorout('Error: [%s] in "%s" from "%s"'%(errormsg,self.params,self.orig))
 		return ret
+	def isconstant(self): # resolves the same in every generated node
+		if self.cmd==None: return True
+		if self.cmd=='variable' or self.cmd=='unmap': return False
+		if self.params:
+			for w in self.params:
+				if not w.isconstant(): return False
+		return True
+	def bind(self): # copy for a generated node, the constant params stay shared
+		r=Word.__new__(Word)
+		r.orig=self.orig
+		r.text=self.text
+		r.texts=self.texts
+		r.escape=self.escape
+		r.cmd=self.cmd
+		r.params=[w if w.isconstant() else w.bind() for w in self.params] if self.params else None
+		r.node=self.node
+		r.relt=self.relt
+		r.nodes=self.nodes
+		return r
+	def unbind(self,uid):
+		if self.node!=None and self.node.uid>=uid:
+			self.node=None
+			self.relt=None
+		if self.params:
+			for w in self.params: w.unbind(uid)
 	def setnode(self,node,relt=1):
 		self.node=node
 		self.relt=relt
 	def setnodes(self,nodes):
 		self.nodes=nodes
 
-class Suppressions():
-	def __init__(self,old=None):
-		if old:
-			self.uids=old.uids.copy()
-		else:
-			self.uids=set()
+class Suppressions(): # one set for the whole export, nodes undo their own changes when they return
+	def __init__(self):
+		self.uids=set()
+		self.undo=[] # (uid,wassuppressed,sig before) for every change
+		self.sig=0 # int naming the current set, 0 is the empty one
+		self.sigs={} # (sig,uid,issuppressed) -> sig after that change
 	def issuppressed(self,nodes,node):
-		if node.uid in self.uids: return True
-		uid=node.getgeneratoruid(nodes)
-		if uid in self.uids: return True
-		return False
+		return node.uid in self.uids or node.generatoruid in self.uids
+	def mark(self):
+		return len(self.undo)
+	def unchangedsince(self,mark): # whether the set is what it was when mark() returned mark, only the changes since count
+		first={}
+		for (uid,was,sig) in self.undo[mark:]: first.setdefault(uid,was)
+		uids=self.uids
+		for uid,was in first.items():
+			if (uid in uids)!=was: return False
+		return True
+	def signature(self): # what's suppressed right now, as a RenderCache key part, equal sigs mean equal sets
+		return self.sig
+	def restore(self,mark):
+		undo=self.undo
+		while len(undo)>mark:
+			(uid,was,self.sig)=undo.pop()
+			if was: self.uids.add(uid)
+			else: self.uids.discard(uid)
+	def set(self,uid,issuppressed):
+		was=uid in self.uids
+		if was==issuppressed: return
+		if issuppressed: self.uids.add(uid)
+		else: self.uids.discard(uid)
+		self.undo.append((uid,was,self.sig))
+		self.sig=self.sigs.setdefault((self.sig,uid,issuppressed),len(self.sigs)+1) # the same change from the same set always gets the same sig, other orders of it are only cache misses
 	def add(self,nodes,node,relt,isunsuppress): # relt: 1: self, 2: all, 3: component, 4: example, 5: item
-		if isunsuppress:
-			if relt==1:
-				self.uids.discard(node.uid)
-			elif relt==2:
-				self.uids.discard(node.uid)
-				for n in node.components: self.uids.discard(n.uid)
-				for n in node.examples: self.uids.discard(n.uid)
-				for n in node.items: self.uids.discard(n.uid)
-			elif relt==3:
-				for n in node.components: self.uids.discard(n.uid)
-			elif relt==4:
-				for n in node.examples: self.uids.discard(n.uid)
-			elif relt==5:
-				for n in node.items: self.uids.discard(n.uid)
-		else:
-			if relt==1:
-				self.uids.add(node.uid)
-			elif relt==2:
-				self.uids.add(node.uid)
-				for n in node.components: self.uids.add(n.uid)
-				for n in node.examples: self.uids.add(n.uid)
-				for n in node.items: self.uids.add(n.uid)
-			elif relt==3:
-				for n in node.components: self.uids.add(n.uid)
-			elif relt==4:
-				for n in node.examples: self.uids.add(n.uid)
-			elif relt==5:
-				for n in node.items: self.uids.add(n.uid)
+		v=not isunsuppress
+		if relt==1 or relt==2:
+			self.set(node.uid,v)
+		if relt==2 or relt==3:
+			for n in node.components: self.set(n.uid,v)
+		if relt==2 or relt==4:
+			for n in node.examples: self.set(n.uid,v)
+		if relt==2 or relt==5:
+			for n in node.items: self.set(n.uid,v)
 	def addpath(self,nodes,path,isunsuppress):
 		(node,relt)=nodes.path_findname(path,None,3)
 		self.add(nodes,node,relt,isunsuppress)
@@ -635,19 +834,22 @@ class Node():
 		self.maps={} # key is uid of dimension, value is array of nodes points to
 		self.revmaps={} # reverse of maps (in destination pointing back), key is dimension uid, value is array of nodes point to us
 		self.generation=None # Generation()
+		self.generatoruid=0 # for generated nodes, uid of the generator, suppressing it suppresses us
+		self.memberuids=None # relt -> set of uids in components/examples/items, see adopt2()
+		self.plan=None # None until our first export, True until the second, then our words as export() renders them, see compileplan()
 	def makeorfindname(self,nodes,relt,w,caller): # relt: 3: components, 4: examples, 5: items
 		if relt==3:
-			nn=nodes.nodesbyuid.get(self.findnamedcomponent(w))
+			nn=self.findnamedcomponent(w)
 			if not nn:
 				nn=nodes.makenode(w,caller)
 				self.addnamedcomponent(w,nn)
 		elif relt==4:
-			nn=nodes.nodesbyuid.get(self.findnamedexample(w))
+			nn=self.findnamedexample(w)
 			if not nn:
 				nn=nodes.makenode(w,caller)
 				self.addnamedexample(w,nn)
 		elif relt==5:
-			nn=nodes.nodesbyuid.get(self.findnameditem(w))
+			nn=self.findnameditem(w)
 			if not nn:
 				nn=nodes.makenode(w,caller)
 				self.addnameditem(w,nn)
@@ -662,26 +864,32 @@ class Node():
 		elif relt==5:
 			if self.findnameditem(w): node_errorout(self,"Duplicate item %s"%w)
 			self.addnameditem(w,node)
-	def adopt2(self,nodes,dest,src,word):
-		s=set()
-		for n in src: s.add(n.uid)
-		if self.uid in src: node_errorout(self,'adoption of self in "%s"'%word)
-		for n in dest: s.add(n.uid)
-		dest.clear()
-		for uid in s:
-			dest.append(nodes.nodesbyuid[uid])
-	def adopt(self,nodes,node,relt,word): # relt: 2: all, 3: components, 4: examples: 5: items
-		if relt==2:
-			self.adopt2(nodes,self.components,node.components,word)
-			self.adopt2(nodes,self.examples,node.examples,word)
-			self.adopt2(nodes,self.items,node.items,word)
-		elif relt==3:
-			self.adopt2(nodes,self.components,node.components,word)
-		elif relt==4:
-			self.adopt2(nodes,self.examples,node.examples,word)
-		elif relt==5:
-			self.adopt2(nodes,self.items,node.items,word)
+	def members(self,relt): # relt: 3: components, 4: examples, 5: items
+		return (self.components,self.examples,self.items)[relt-3]
+	def memberindex(self,relt): # set of uids in members(relt), made on first use and kept up to date by the add functions
+		if self.memberuids==None: self.memberuids={}
+		ix=self.memberuids.get(relt)
+		if ix==None: ix=self.memberuids[relt]=set(map(uidkey_global,self.members(relt)))
+		return ix
+	def indexmember(self,relt,node):
+		ix=self.memberuids.get(relt)
+		if ix!=None: ix.add(node.uid)
+	def adopt2(self,nodes,relt,node,word): # returns True if members(relt) must be rebuilt in uid order, see postbuild
+		dest=self.members(relt)
+		ix=self.memberindex(relt)
+		issort=len(ix)!=len(dest) # duplicates, those get dropped
+		srcix=node.memberindex(relt)
+		newuids=srcix.difference(ix)
+		if not newuids: return issort
+		ix.update(newuids)
+		if dest and dest[-1].uid>min(newuids): return True # interleaved
+		dest.extend(map(nodes.nodesbyuid.__getitem__,sorted(newuids)))
+		return issort
+	def adopt(self,nodes,node,relt,word): # relt: 2: all, 3: components, 4: examples: 5: items, returns the relts to rebuild
+		if relt==2: relts=(3,4,5)
+		elif relt in (3,4,5): relts=(relt,)
 		else: node_errorout(self,'adopt with invalid relt: %s in word "%s"'%(relttostring(relt),word))
+		return [r for r in relts if self.adopt2(nodes,r,node,word)]
 	def name_cmd(self,nodes,params):
 		np=len(params)
 		if not np: node_errorout(self,"empty name")
@@ -731,6 +939,7 @@ class Node():
 			if w.cmd=='name':
 				if 1!=len(w.params): errorout('name takes 1 parameter, got: "%s"'%w.params)
 				self.name_cmd(nodes,w.params[0].params)
+		if self.generation and self.generation.isgenerator: self.generation.compile(self.words)
 	def prebuild(self,nodes,globalvars):
 		for w in self.words:
 			if not w.cmd: continue
@@ -772,6 +981,7 @@ class Node():
 				else:
 					node_errorout(self,'unmap takes 1 or 2 parameters, got "%s"'%w.params)
 				if dimp.cmd!='path': node_errorout(self,'unmap takes a path parameter, got "%s"'%dimp)
+				if dimp.node and dimp.isconstant(): continue
 				(dimnode,relt)=nodes.findpath(dimp.params,self,globalvars,1)
 				dimp.setnode(dimnode,relt)
 			elif w.cmd in ('global0','globalint','globalstring', # Phase0
@@ -792,6 +1002,7 @@ class Node():
 		return ret
 	def flattenword(self,nodes,globalvars,word):
 		if word.text: return
+		if word.node and word.isconstant(): return # shared with the generator, already resolved
 		for w in word.params:
 			self.flattenword(nodes,globalvars,w)
 		if word.cmd=='variable':
@@ -824,8 +1035,10 @@ class Node():
 	def postbuild(self,nodes,globalvars_in):
 		globalvars=globalvars_in.clone()
 		globalvars.setvar('_uid',self.uid)
+		unsorted=[] # relts that adopted members out of order
 		for w in self.words:
 			if not w.cmd: continue
+			if w.node and w.isconstant(): continue # shared with the generator, already resolved
 			if w.cmd=='include':
 				if 1==len(w.params): pass
 				elif 2==len(w.params):
@@ -840,7 +1053,7 @@ class Node():
 				p0=w.params[0]
 				if p0.cmd!='path': node_errorout(self,'_adopt takes a path parameter, got "%s"'%w)
 				(node,relt)=nodes.findpath(p0.params,self,globalvars,2)
-				self.adopt(nodes,node,relt,w)
+				unsorted+=self.adopt(nodes,node,relt,w)
 			elif w.cmd=='unmap':
 				self.flattenword(nodes,globalvars,w)
 			elif w.cmd=='suppress':
@@ -861,24 +1074,48 @@ class Node():
 				w.relt=relt
 			elif w.cmd in ('set','setstring','unset','sum','printvar','assert'):
 				self.flattenword(nodes,globalvars,w)
+		for relt in set(unsorted): # adopted members are merged in the order of the input
+			self.members(relt)[:]=map(nodes.nodesbyuid.__getitem__,sorted(self.memberuids[relt]))
+	def forget(self,uid): # drops references to nodes >= uid, those were all appended after any to older nodes
+		self.memberuids=None
+		self.components[:]=[n for n in self.components if n.uid<uid]
+		self.examples[:]=[n for n in self.examples if n.uid<uid]
+		self.items[:]=[n for n in self.items if n.uid<uid]
+		for d in (self.named_components,self.named_examples,self.named_items):
+			for name in [name for name,n in d.items() if n.uid>=uid]: del d[name]
+		for d in (self.maps,self.revmaps):
+			for k in list(d):
+				va=[n for n in d[k] if n.uid<uid]
+				if k>=uid or not va: del d[k]
+				elif len(va)!=len(d[k]): d[k][:]=va
+		if self.generation:
+			gd=self.generation.generateds
+			for cname in [cname for cname,u in gd.items() if u>=uid]: del gd[cname]
+			if self.generation.isgenerator: self.generation.forget(uid)
 	def findnamedcomponent(self,name): return self.named_components.get(name)
 	def addnamedcomponent(self,name,node):
 		self.components.append(node)
 		self.named_components[name]=node
+		if self.memberuids: self.indexmember(3,node)
 	def addcomponent(self,node):
 		self.components.append(node)
+		if self.memberuids: self.indexmember(3,node)
 	def findnamedexample(self,name): return self.named_examples.get(name)
 	def addnamedexample(self,name,node):
 		self.examples.append(node)
 		self.named_examples[name]=node
+		if self.memberuids: self.indexmember(4,node)
 	def addexample(self,node):
 		self.examples.append(node)
+		if self.memberuids: self.indexmember(4,node)
 	def findnameditem(self,name): return self.named_items.get(name)
 	def addnameditem(self,name,node):
 		self.items.append(node)
 		self.named_items[name]=node
+		if self.memberuids: self.indexmember(5,node)
 	def additem(self,node):
 		self.items.append(node)
+		if self.memberuids: self.indexmember(5,node)
 	def addmap(self,dimnode,destnode):
 		va=self.maps.get(dimnode.uid)
 		if not va: va=self.maps[dimnode.uid]=[]
@@ -890,10 +1127,7 @@ class Node():
 		va=self.maps.get(dimnode.uid)
 		if not va: return empty # [] is static
 		return va
-	def word_export(self,nodes,suppressions,po,depth,word):
-		if not depth: node_errorout(self,'Recursion depth too high')
-		depth-=1
-
+	def word_export(self,nodes,suppressions,po,word):
 		if word.node:
 			if suppressions.issuppressed(nodes,word.node): return
 			for w in word.node.words:
@@ -901,58 +1135,194 @@ class Node():
 			return
 		if word.nodes:
 			for node in word.nodes:
-				self.word_export(nodes,suppressions,po,depth,Word.node(node))
+				self.word_export(nodes,suppressions,po,Word.node(node))
 		if po.addword(word): return
 		node_errorout(self,'word_export: unhandled format: %s'%word)
-	def export(self,nodes,suppressions_in,po,depth,relt=1,childbreak=None):
-		if suppressions_in.issuppressed(nodes,self): return
-
-		if not depth: node_errorout(self,'Recursion depth too high')
-		depth-=1
-
-		suppressions=suppressions_in
-
-		if relt==0:
-			relt=3 if self.components else 1
-
-		if relt==3:
-			for i,node in enumerate(self.components):
-				if i and childbreak: self.word_export(nodes,suppressions,po,depth,childbreak)
-				node.export(nodes,suppressions,po,depth)
-		elif relt==4:
-			for i,node in enumerate(self.examples):
-				if i and childbreak: self.word_export(nodes,suppressions,po,depth,childbreak)
-				node.export(nodes,suppressions,po,depth)
-		elif relt==5:
-			for i,node in enumerate(self.items):
-				if i and childbreak: self.word_export(nodes,suppressions,po,depth,childbreak)
-				node.export(nodes,suppressions,po,depth)
-		else:
-			for w in self.words:
-				if w.nodes:
-					for node in w.nodes:
-						node.export(nodes,suppressions,po,depth)
-				elif w.text: po.literal(w.text)
-				elif w.escape: po.escape(w.escape)
-				elif w.cmd:
-					if w.cmd=='include':
+	def compileplan(self): # the second time we're exported, compiling a node that is only exported once would cost more than it saves
+		words=self.words
+		gen=self.generation
+		gg=gen.generator.generation if gen and gen.generator else None
+		if gg and gg.nwords==len(words): # generateds share their generator's literals and escapes, and so its StaticRuns
+			if gg.plan==None: gg.plan=Node.plantemplate(gen.generator.words)
+			template=gg.plan
+		else: template=Node.plantemplate(words)
+		self.plan=[x if x.__class__ is StaticRun else words[x] for x in template]
+		return self.plan
+	def plantemplate(words): # a StaticRun for each run of literals and escapes, the index of every other word
+		plan=[]
+		parts=[]
+		for j,w in enumerate(words):
+			if w.cmd==None: # these never change, resolved words are all commands
+				if w.text: parts.append((False,w.text))
+				elif w.escape: parts.append((True,w.escape))
+				continue
+			if parts:
+				plan.append(StaticRun(tuple(parts)))
+				parts=[]
+			plan.append(j)
+		if parts: plan.append(StaticRun(tuple(parts)))
+		return plan
+	def reenter(node,suppressions,marks): # node is on the export stack already, marks: one suppressions.mark() or a list, returns them with this one
+		if marks.__class__ is int: marks=[marks]
+		for m in marks:
+			if suppressions.unchangedsince(m): node_errorout(node,'Recursion cycle: node includes itself') # the same state again would never end
+		marks.append(suppressions.mark())
+		return marks
+	def export(self,nodes,suppressions,po,maxdepth=0,relt=1,childbreak=None,memo=None,members=None): # iterative, maxdepth 0 means no limit, memo: a RenderCache, members: a run of our relt members to export instead of all
+		uids=suppressions.uids # suppressions.issuppressed(), inlined
+		if maxdepth: memo=None # replays would skip the depth checks
+		realpo=po # po is memo while a node records
+		literal=po.literal
+		static=po.static
+		stack=[] # saved (cur,key,words,i,n,pend,k,cb,mark,rec) of the nodes we are inside of
+		active={} # uid<<3|relt of the nodes on the stack -> suppressions.mark() when it was entered, a list of them if it's there more than once, see Node.reenter
+		undo=suppressions.undo
+		depth=0
+		cur=None # node being exported
+		key=None # uid<<3|relt of cur once it's on the stack, or if it exports its child nodes
+		words=() # cur's plan or words, () if it exports its child nodes
+		i=0 # next index in words
+		n=0
+		pend=None # nodes to export one by one before going on with words: cur's child nodes, or those of a word
+		k=0 # next index in pend
+		cb=None # childbreak between cur's child nodes
+		mark=None # set once cur changes the suppressions, they are restored when it's done
+		rec=None # (memo key,start in memo.calls,isoutermost) if cur is recording
+		node=self
+		while True:
+			if node: # enter it, it only gets a frame on the stack if it needs one
+				if node.uid not in uids and node.generatoruid not in uids:
+					if maxdepth and depth>=maxdepth: node_errorout(node,'Recursion depth too high')
+					if relt==0:
+						relt=3 if node.components else 1
+					j=0
+					if 3<=relt<=5:
+						nodewords=()
+						nn=0
+					else: # words up to one in framecommands_global are written right away, most nodes are done here
+						nodewords=node.plan
+						if nodewords.__class__ is not list:
+							if nodewords: nodewords=node.compileplan()
+							else:
+								node.plan=True
+								nodewords=node.words
+						nn=len(nodewords)
+						while j<nn:
+							w=nodewords[j]
+							if w.__class__ is StaticRun: static(w)
+							elif w.nodes: break
+							elif w.text: literal(w.text)
+							elif w.escape: po.escape(w.escape)
+							elif w.cmd in framecommands_global: break
+							elif w.cmd: po.command(w.cmd,w.params)
+							j+=1
+						else:
+							node=None
+							continue
+					nextrec=None
+					if memo!=None:
+						seen=memo.visits.get(node.uid,0)
+						if seen>=2: # what's left of it only depends on the suppressions
+							if 3<=relt<=5: mkey=(node.uid,relt,childbreak,suppressions.signature())
+							else: mkey=(node.uid,relt,None,suppressions.signature())
+							seg=memo.segs.get(mkey)
+							if seg!=None:
+								memo.hits+=1
+								RenderCache.replay(seg,po)
+								node=None
+								continue
+							memo.misses+=1
+							nextrec=(mkey,len(memo.calls),po is not memo)
+						else: memo.visits[node.uid]=seen+1
+					if key==None and cur:
+						key=cur.uid<<3|1
+						m=active.get(key)
+						if m==None: active[key]=len(undo)
+						else: active[key]=Node.reenter(cur,suppressions,m)
+					stack.append((cur,key,words,i,n,pend,k,cb,mark,rec))
+					depth+=1
+					rec=nextrec
+					if rec and rec[2]:
+						po=memo
+						literal=po.literal
+						static=po.static
+					cur=node
+					words=nodewords
+					i=j
+					n=nn
+					k=0
+					mark=None
+					if 3<=relt<=5:
+						key=node.uid<<3|relt
+						m=active.get(key)
+						if m==None: active[key]=len(undo)
+						else: active[key]=Node.reenter(node,suppressions,m)
+						pend=node.components if relt==3 else node.examples if relt==4 else node.items
+						if members!=None: # only for self, see Document.exportparallel
+							pend=members
+							members=None
+						cb=childbreak
+					else:
+						key=None
+						pend=None
 						cb=None
-						if 2==len(w.params): cb=w.params[1]
+				node=None
+			if pend is not None:
+				if k<len(pend):
+					if k and cb: cur.word_export(nodes,suppressions,po,cb)
+					node=pend[k]
+					k+=1
+					relt=1
+					childbreak=None
+					continue
+				pend=None
+			if i<n:
+				while i<n: # until a word with nodes to export
+					w=words[i]
+					i+=1
+					if w.__class__ is StaticRun: static(w)
+					elif w.nodes:
+						pend=w.nodes
+						k=0
+						break
+					elif w.text: literal(w.text)
+					elif w.escape: po.escape(w.escape)
+					elif not w.cmd: pass
+					elif w.cmd=='include':
 						node=w.node
-						node.export(nodes,suppressions,po,depth,relt=w.relt,childbreak=cb)
+						relt=w.relt
+						childbreak=w.params[1] if 2==len(w.params) else None
+						break
 					elif w.cmd=='variable':
-						if w.node: po.literal('#%s(%s)'%(w.node.uid,w.node.nickname))
+						if w.node: literal('#%s(%s)'%(w.node.uid,w.node.nickname))
 					elif w.cmd=='unmap':
-						for node in w.nodes:
-							node.export(nodes,suppressions,po,depth)
+						if w.nodes==None: node_errorout(cur,'unmap is only resolved in generated nodes, not in their generator')
 					elif w.cmd=='suppress':
-						if suppressions==suppressions_in: suppressions=Suppressions(suppressions_in)
+						if mark==None: mark=suppressions.mark()
 						suppressions.add(nodes,w.node,w.relt,False)
 					elif w.cmd=='unsuppress':
-						if suppressions==suppressions_in: suppressions=Suppressions(suppressions_in)
+						if mark==None: mark=suppressions.mark()
 						suppressions.add(nodes,w.node,w.relt,True)
 					else:
 						po.command(w.cmd,w.params)
+				continue
+			# cur is done
+			if mark!=None: suppressions.restore(mark)
+			if key:
+				m=active.pop(key)
+				if m.__class__ is list and len(m)>1:
+					m.pop()
+					active[key]=m
+			if rec:
+				memo.segs[rec[0]]=memo.calls[rec[1]:]
+				if rec[2]:
+					memo.calls.clear()
+					po=realpo
+					literal=po.literal
+					static=po.static
+			if not stack: return
+			(cur,key,words,i,n,pend,k,cb,mark,rec)=stack.pop()
+			depth-=1
 	def components_export(self,po):
 		for node in self.components:
 			node.dump()
@@ -966,11 +1336,7 @@ class Node():
 		if not self.generation: self.generation=Generation(self)
 		self.generation.addgenerated(cname,node.uid)
 	def getgeneratoruid(self,nodes):
-		x=self.generation
-		if not x: return 0
-		x=x.generator
-		if not x: return 0
-		return x.uid
+		return self.generatoruid
 	def dump(self):
 		print("Node %s: %s"%(self.uid,self.nickname or ''))
 		if self.orig_lines: print("orig:",self.orig_lines)
@@ -997,14 +1363,19 @@ class Nodes():
 	def __init__(self):
 		self.nextuid=1
 		self.nodes=[]
-		self.nodesbyuid={}
+		self.nodesbyuid=[None] # uid -> node, uids are dense from 1
 		self.nodesbyname={}
 		self.globalvars=None
+		self.chunkwords=[] # words of each active chunk built, for .update
+		self.chunknodes=[] # node made for each active chunk, all later uids were created after it
+		self.pathcache={} # (def_relt,pathkey()) -> (node,relt), names can't be rebound so only rollback clears it
+		self.pathhits=0
+		self.pathmisses=0
 	def setglobalvars(self,g): self.globalvars=g
 	def createnode(self,lines):
 		node=Node(self.nextuid,lines)
 		self.nodes.append(node)
-		self.nodesbyuid[self.nextuid]=node
+		self.nodesbyuid.append(node)
 		self.nextuid+=1
 		return node
 	def adddefaultnode(self):
@@ -1031,6 +1402,44 @@ class Nodes():
 			node.prebuild(self,self.globalvars) # this fixes maps and variables
 			node.postbuild(self,self.globalvars) # can now access maps, we can pass our uid to generators
 		return node
+	def addchunks(self,chunks):
+		defaultnode=self.nodesbyname['_default']
+		isgc=gc.isenabled()
+		gc.disable() # as in loadsnapshot, every generated node would make the collector rescan the growing graph
+		try:
+			for chunk in chunks:
+				if not chunk.isactive: continue
+				node=self.lines_addnode(chunk.words,chunk.lines)
+				self.chunkwords.append(chunk.words)
+				self.chunknodes.append(node)
+				if not node.ismarked:
+					defaultnode.addcomponent(node)
+		finally:
+			if isgc: gc.enable()
+	def rollback(self,uid): # forget uid and every later node, as if they had never been built
+		del self.nodes[uid-1:]
+		del self.nodesbyuid[uid:]
+		self.nextuid=uid
+		self.pathcache.clear()
+		for name in [name for name,node in self.nodesbyname.items() if node.uid>=uid]:
+			del self.nodesbyname[name]
+		for node in self.nodes: node.forget(uid)
+	def update(self,p0): # rebuilds from the first changed chunk onward, returns False if a full build is needed
+		if self.globalvars.vars!=p0.globalvars.vars: return False
+		chunks=[chunk for chunk in p0.chunks if chunk.isactive]
+		n=min(len(chunks),len(self.chunkwords))
+		k=0
+		while k<n and chunks[k].words==self.chunkwords[k]:
+			self.chunknodes[k].orig_lines=chunks[k].lines
+			k+=1
+		if not k: return False # nothing to reuse
+		if k<len(self.chunknodes): self.rollback(self.chunknodes[k].uid)
+		else: self.rollback(self.nextuid) # drops nodes generated during exports
+		del self.chunkwords[k:]
+		del self.chunknodes[k:]
+		self.globalvars=p0.globalvars
+		self.addchunks(chunks[k:])
+		return True
 	def makenode(self,name,caller):
 		if not name or not name[0].isalnum(): errorout('Illegal node name: %s'%name)
 		node=self.createnode(None)
@@ -1038,23 +1447,27 @@ class Nodes():
 		return node
 	def registerowner(self,name,node):
 		if name in self.nodesbyname: node_errorout(node,'Node already exists: "%s"'%name)
+		name=sys.intern(name)
 		node.nickname=name
 		self.nodesbyname[name]=node
 	def nodes_dump(self):
 		for node in self.nodes: node.dump()
 	def names_dump(self):
 		for name in self.nodesbyname:
+			if type(name) is not str: name=self.canonicalname(name)
 			print("%s (%s)"%(name,type(name)))
 	def name_findtopnode(self,name):
 		return self.nodesbyname.get(name)
 	def makegenenode(self,generator,params,cname,caller):
 		node=self.createnode(None)
-		node.nickname=cname
-		node.words=Word.clonewords(generator.words)
+		node.nickname=self.canonicalname(cname)
+		gg=generator.generation
+		node.words=gg.clonewords(generator.words) if gg else Word.clonewords(generator.words)
 		gen=Generation(node,False)
 		gen.setvalues(params)
 		gen.setgenerator(generator)
 		node.generation=gen
+		node.generatoruid=generator.uid
 		generator.addgenerated(cname,node)
 		return node
 	def findtopgenenode(self,w,globalvars,caller):
@@ -1078,8 +1491,20 @@ class Nodes():
 			return node
 		node_errorout(caller,'Unknown format: w: "%s"'%(w))
 	def findpath(self,params,node,globalvars,def_relt):
+		if len(params)==1 and params[0].text!=None: return self.resolvepath(params,node,globalvars,def_relt) # just a lookup
+		key=pathkey(params,globalvars)
+		if key==None: return self.resolvepath(params,node,globalvars,def_relt)
+		key=(def_relt,key)
+		ret=self.pathcache.get(key)
+		if ret:
+			self.pathhits+=1
+			return ret
+		self.pathmisses+=1
+		ret=self.pathcache[key]=self.resolvepath(params,node,globalvars,def_relt)
+		return ret
+	def resolvepath(self,params,node,globalvars,def_relt):
 		np=len(params)
-		if not np: node_errorout(node,"empty path in %s"%path)
+		if not np: node_errorout(node,"empty path in %s"%params)
 		p=params[0]
 		nn=self.findtopgenenode(p,globalvars,node)
 		if not nn: node_errorout(node,'topnode not found "%s"'%(p))
@@ -1087,7 +1512,7 @@ class Nodes():
 		relt=0 # 1: self, 2: all, 3: components, 4: examples, 5: items
 		for w in params[1:]:
 			w=w.onlytext(self)
-			if not w: node_errorout(node,"empty name component in %s"%path)
+			if not w: node_errorout(node,"empty name component in %s"%params)
 			if w[0]=='_':
 				if w in ('_component','_components','_c'): relt=3
 				elif w in ('_example','_examples','_e'): relt=4
@@ -1116,16 +1541,33 @@ class Nodes():
 	def path_findname(self,path,node,defrelt): # this is meant to be called from main
 		params=parsenamestring(path,node)
 		return self.findpath(params,node,self.globalvars,defrelt)
-	def makecanonical(self,generator,params):
-		a=[]
-		a.append('('+generator+')')
-		for p in params:
-			a.append('(%s)'%p)
-		return ''.join(a)
+	def loadsnapshot(fn):
+		isgc=gc.isenabled()
+		gc.disable() # the collector would otherwise rescan the graph many times while it's being allocated
+		try:
+			with open(fn,'rb') as f: nodes=pickle.load(f)
+		except (OSError,EOFError,pickle.UnpicklingError,AttributeError,ValueError): return None
+		finally:
+			if isgc: gc.enable()
+		if not isinstance(nodes,Nodes): return None
+		return nodes
+	def savesnapshot(self,fn):
+		tmpfn='%s.%s'%(fn,os.getpid())
+		try:
+			with open(tmpfn,'wb') as f: pickle.dump(self,f,pickle.HIGHEST_PROTOCOL)
+			os.replace(tmpfn,fn)
+		except (OSError,RecursionError,pickle.PicklingError): # the snapshot is only an optimization
+			try: os.remove(tmpfn)
+			except OSError: pass
+	def makecanonical(self,generator,params): # key of a generated node in nodesbyname and generateds
+		return (generator,)+tuple(map(str,params)) # as text, so a literal 5 and node #5 share one, as they always did
+	def canonicalname(self,cname): # printable form of a canonical key, only made once per generated node
+		return ''.join(['(%s)'%p for p in cname])
 
 class RuntimeVars():
-	def __init__(self):
+	def __init__(self,fout): # fout only needs .write
 		self.vars={'sum':Fraction(0)}
+		self.fout=fout
 	def run(self,w):
 		cmd=w.cmd
 		params=w.textparams('Runtimevars only support text parameters')
@@ -1154,8 +1596,8 @@ class RuntimeVars():
 			for v in params:
 				if not v in self.vars: errorout('Bad var %s'%(v))
 				nd=self.vars[v].as_integer_ratio()
-				if nd[1]==1: print(nd[0],end='')
-				else: print(float(self.vars[v]),end='')
+				if nd[1]==1: self.fout.write(str(nd[0]))
+				else: self.fout.write(str(float(self.vars[v])))
 		elif cmd=='assert':
 			for p in params:
 				c=True
@@ -1177,8 +1619,10 @@ class html_Escapes():
 				'Bold':'<b>','bold':'</b>',
 				'Italic':'<i>','italic':'</i>',
 				'Underline':'<u>','underline':'</u>', }
+	all=0 # filter() never changes anything
 	def process(self,w): return self.dict[w]
 	def filter(self,w): return w
+	def isstatic(self,w): return w in self.dict # process(w) is always the same, see StaticRun.compile
 
 class xhtml_Escapes():
 # this WILL print redundant closes
@@ -1189,8 +1633,10 @@ class xhtml_Escapes():
 				'Bold':'<b>','bold':'</b>',
 				'Italic':'<i>','italic':'</i>',
 				'Underline':'<u>','underline':'</u>', }
+	all=0 # filter() never changes anything
 	def process(self,w): return self.dict[w]
 	def filter(self,w): return w
+	def isstatic(self,w): return w in self.dict # process(w) is always the same, see StaticRun.compile
 
 class text_Escapes():
 # this will NOT print redundant closes
@@ -1236,6 +1682,7 @@ class text_Escapes():
 		if w!=' ': return w
 		if self.bold: return '*'
 		return '_'
+	def isstatic(self,w): return w in ('Paragraph','paragraph','br')
 
 class Escapes:
 	def find(name):
@@ -1245,21 +1692,145 @@ class Escapes:
 		raise ValueError('Unknown escapes type: %s'%name)
 		return None
 
-class PreOutput():
-	def __init__(self,globalvars,fout):
-		self.words=[]
+class StaticRun(): # adjacent literal and escape words of a node, written by PreOutput.static, see Node.compileplan
+	__slots__=('parts','modes')
+	def __init__(self,parts):
+		self.parts=parts # ((isescape,text),...)
+		self.modes={} # escapes class -> pieces, see compile
+	def compile(parts,escapes): # pieces: the name of an escape that depends on the escapes state, or (parts between those,{separator: join() of them})
+		pieces=[]
+		start=0
+		for j,(isescape,text) in enumerate(parts):
+			if isescape and text not in ('space','backspace','t','n') and not escapes.isstatic(text):
+				if start<j: pieces.append((parts[start:j],{}))
+				pieces.append(text)
+				start=j+1
+		if start<len(parts): pieces.append((parts[start:],{}))
+		return pieces
+	def join(parts,escapes,sep): # (text if wantspace is off,text if it's on,wantspace after or None if unchanged,isbrokenline after or None) as PreOutput writes parts while escapes.filter(' ') is sep
+		out=[]
+		at=None # where the space goes if wantspace is on
+		ws=None
+		for isescape,text in parts:
+			if not isescape:
+				if ws==None: at=len(out)
+				elif ws: out.append(sep)
+				out.append(sep if text==' ' else text)
+				ws=True
+			elif text=='space':
+				out.append(sep)
+				ws=False
+			elif text=='backspace': ws=False
+			elif text=='t':
+				out.append('\t')
+				ws=False
+			elif text=='n':
+				out.append('\n')
+				ws=False
+			else:
+				if text=='br': ws=False
+				out.append(escapes.process(text))
+		s=''.join(out)
+		return (s,s if at==None else ''.join(out[:at])+sep+''.join(out[at:]),ws,s[-1]!='\n' if s else None)
+
+class PreOutputs(): # sends the same words to several PreOutputs, e.g. one per escapes mode
+	def __init__(self,pos):
+		self.pos=pos
+	def literal(self,text):
+		for po in self.pos: po.literal(text)
+	def escape(self,text):
+		for po in self.pos: po.escape(text)
+	def addword(self,word):
+		ret=False
+		for po in self.pos: ret=po.addword(word)
+		return ret
+	def command(self,text,params):
+		for po in self.pos: po.command(text,params)
+	def static(self,run):
+		for po in self.pos: po.static(run)
+	def finalize(self):
+		for po in self.pos: po.finalize()
+
+class RenderCache(): # records what a node sends to the PreOutput on its third visit and replays it after that, see Node.export
+	def __init__(self,po):
+		self.po=po
+		self.calls=[] # (kind,a,b) sent to po since recording started, kind: 0: literal, 1: escape, 2: command, 3: addword, 4: static
+		self.segs={} # (uid,relt,childbreak,suppressions.signature()) -> calls made by that node
+		self.visits={} # uid -> times rendered without recording, up to 2, the third visit records
+		self.hits=0
+		self.misses=0
+	def literal(self,text):
+		self.calls.append((0,text,None))
+		self.po.literal(text)
+	def escape(self,text):
+		self.calls.append((1,text,None))
+		self.po.escape(text)
+	def command(self,text,params):
+		self.calls.append((2,text,params))
+		self.po.command(text,params)
+	def addword(self,word):
+		self.calls.append((3,word,None))
+		return self.po.addword(word)
+	def static(self,run):
+		self.calls.append((4,run,None))
+		self.po.static(run)
+	def replay(seg,po): # po is a RenderCache while an outer node records
+		literal=po.literal
+		escape=po.escape
+		for kind,a,b in seg:
+			if kind==4: po.static(a)
+			elif kind==0: literal(a)
+			elif kind==1: escape(a)
+			elif kind==2: po.command(a,b)
+			else: po.addword(a)
+
+class Segment(): # stands in for the PreOutput in a Document.exportparallel worker, its calls are sent back to be replayed in order
+	def __init__(self):
+		self.calls=[] # (kind,a,b), kind: 0: literal, 1: escape, 2: runtime command with b the text of its params, 3: StaticRun parts, all marshal can send
+	def literal(self,text):
+		self.calls.append((0,text,None))
+	def escape(self,text):
+		self.calls.append((1,text,None))
+	def command(self,text,params): # PreOutput ignores other commands
+		if text in ('set','setstring','unset','sum','printvar','assert'):
+			self.calls.append((2,text,[w.text for w in params] if params else None))
+	def addword(self,word): # as PreOutput.addword
+		if word.escape: self.escape(word.escape) ; return True
+		if word.text: self.literal(word.text) ; return True
+		return False
+	def static(self,run):
+		self.calls.append((3,run.parts,None))
+	def replay(calls,po,runs): # runtime commands run here, in order, so their state carries from one segment to the next, runs: parts -> StaticRun, kept over segments
+		literal=po.literal
+		escape=po.escape
+		for kind,a,b in calls:
+			if kind==3:
+				run=runs.get(a)
+				if run==None: run=runs[a]=StaticRun(a)
+				po.static(run)
+			elif kind==0: literal(a)
+			elif kind==1: escape(a)
+			else: po.command(a,[Word.literal(t) for t in b] if b else None)
+
+class PreOutput(): # resolves spacing, escapes and runtime commands as words arrive
+	def __init__(self,globalvars,fout,isforce=None):
 		self.wantspace=False
-		self.space=Word(' ')
 		self.globalvars=globalvars
 		self.fout=fout
 		self.isbrokenline=False
+		self.isassertcheck=True
+		if globalvars.istrue('_noassert'): self.isassertcheck=False
+		if isforce: self.isassertcheck=not isforce
+		self.escapes=Escapes.find(globalvars.getstring('_escapesmode'))
+		self.rv=RuntimeVars(self)
+		self.buffer=[] # pending writes, joined in .flush
 	def literal(self,text):
-		if self.wantspace: self.words.append(self.space)
+		if self.wantspace: self.printout(self.escapes.filter(' '))
 		else: self.wantspace=True
-		self.words.append(Word.literal(text))
+		self.printout(self.escapes.filter(text))
 	def escape(self,text):
 		if text=='space':
-			self.words.append(self.space)
+			self.printout(self.escapes.filter(' '))
 			self.wantspace=False
 			return
 		if text=='backspace':
@@ -1267,132 +1838,552 @@ class PreOutput():
 			return
 		if text in ('t','n','br'):
 			self.wantspace=False
-		w=Word.escape(text)
-		self.words.append(w)
+		if text=='t': self.printout('\t')
+		elif text=='n': self.printout('\n')
+		else: self.printout(self.escapes.process(text))
 	def addword(self,word):
 		if word.escape: self.escape(word.escape) ; return True
 		if word.text: self.literal(word.text) ; return True
 		return False
+	def static(self,run): # as .literal and .escape for each of run.parts, joined beforehand
+		escapes=self.escapes
+		pieces=run.modes.get(escapes.__class__)
+		if pieces==None: pieces=run.modes[escapes.__class__]=StaticRun.compile(run.parts,escapes)
+		for p in pieces:
+			if p.__class__ is str:
+				self.escape(p)
+				continue
+			sep=escapes.filter(' ') if escapes.all else ' ' # text escapes write spaces as * or _ inside bold, italic or underline
+			j=p[1].get(sep)
+			if j==None: j=p[1][sep]=StaticRun.join(p[0],escapes,sep)
+			s=j[1] if self.wantspace else j[0]
+			if s:
+				self.isbrokenline=j[3]
+				self.write(s)
+			if j[2]!=None: self.wantspace=j[2]
 	def command(self,text,params):
-		if text not in ('set','setstring','unset','sum','printvar','assert'): return
-		w=Word.command(text,text,params)
-		self.words.append(w)
+		if text in ('set','setstring','unset','sum','printvar'):
+			self.rv.run(Word.command(text,text,params))
+		elif text=='assert':
+			if self.isassertcheck: self.rv.run(Word.command(text,text,params))
+	def write(self,text):
+		self.buffer.append(text)
+		if len(self.buffer)>=4096: self.flush()
+	def flush(self):
+		self.fout.write(''.join(self.buffer))
+		self.buffer.clear()
 	def printout(self,text):
 		if 0==len(text): return
 		self.isbrokenline=(text[-1]!='\n')
-		print(text,end='',file=self.fout)
-	def finalize(self,isforce=None):
-		isassertcheck=True
-		if self.globalvars.istrue('_noassert'): isassertcheck=False
-		if isforce: isassertcheck=not isforce
-		escapesmode=self.globalvars.getstring('_escapesmode')
-		escapes=Escapes.find(escapesmode)
-		rv=RuntimeVars()
-		for w in self.words:
-			if w.text: self.printout(escapes.filter(w.text)) ; continue
-			if w.escape:
-				if w.escape=='t': self.printout('\t')
-				elif w.escape=='n': self.printout('\n')
-#				elif w.escape=='space': print(escapes.filter(' '),end='',file=fout)
-				else: self.printout(escapes.process(w.escape))
-			elif w.cmd:
-				if w.cmd in ('set','setstring','unset','sum','printvar'):
-					rv.run(w)
-				elif w.cmd=='assert':
-					if isassertcheck: rv.run(w)
+		self.write(text)
+	def finalize(self):
+		self.flush()
+
+def newphase0(vars=[],escapesmode='html',cachedir=None):
+	p0=Phase0()
+	p0.setvarcmd('._globalstring(_escapesmode,%s)'%escapesmode)
+	if cachedir: p0.setcachedir(cachedir)
+	for arg in vars: p0.globalvars.setvarparse(arg) # "a", "a=" or "a=b", as +vars on the command line
+	return p0
+
+def loadphase0(files,vars=[],escapesmode='html',cachedir=None,jobs=1): # reads files and does conditional inclusion
+	p0=newphase0(vars,escapesmode,cachedir)
+	p0.addfiles(files,jobs)
+	p0.process()
+	return p0
+
+class ChunkIndex(): # which active chunks name, join and mention which nodes, from their raw words, for lazy builds
+	nametoken=re.compile(r'(?<![\w$])[^\W_][^\s.:/()=]*') # a node name in a dot word, not a $variable or a _reserved word
+	vartoken=re.compile(r'\$([^\s.:/(),=]+)')
+	def __init__(self,chunks):
+		self.chunks=[chunk for chunk in chunks if chunk.isactive]
+		self.definers={} # name -> [i,...] of chunks naming it
+		self.joiners={} # name -> [i,...] of chunks joining it, including generators whose generateds do
+		self.referrers={} # name -> [i,...] of chunks mentioning it, these make the generateds of a generator
+		self.generators={} # i -> name, for generator chunks
+		self.deps=[] # i -> (names that must exist, names whose members are needed too), None if only a full build is safe
+		for i,chunk in enumerate(self.chunks):
+			self.deps.append(self.scan(i,chunk.words))
+	def refnames(text,dest):
+		for name in ChunkIndex.nametoken.findall(text):
+			dest.add(name)
+			if ',' in name: dest.update(name.split(',')) # names can have commas, parameters are split by them
+		if '_default' in text: dest.add('_default')
+		if '_l(' in text or '_literal(' in text: dest.add('_literal')
+	def lastname(text): # (name of the node a path ends at, '' if a variable picks it, the path before it)
+		name=''
+		parent=''
+		start=0
+		pcount=0
+		n=len(text)
+		for k in range(n+1):
+			c=text[k] if k<n else '.'
+			if c=='(': pcount+=1
+			elif c==')': pcount-=1
+			elif not pcount and c in '.:/':
+				part=text[start:k]
+				if part and name: parent=text[:start-1]
+				start=k+1
+				if part[:1]=='(' and part[-1:]==')': part=part[1:-1] # (_c) or (name)
+				if not part: continue
+				if part=='_default': name=part
+				elif part.startswith(('_l(','_literal(')): name='_literal'
+				elif part[0]=='_': continue # _c, _e, _i, _s
+				elif part[0]=='$': return ('',parent)
+				else:
+					j=part.find('(')
+					name=part[:j] if j>=0 else part
+		return (name,parent)
+	def scan(self,i,words): # indexes chunk i, returns its deps
+		exists=set()
+		contents=set()
+		vars=set()
+		params=set()
+		isfull=False
+		for w in words:
+			if len(w)<2 or w[0]!='.': continue
+			c=w[1]
+			if c=='?': continue
+			if '$' in w: vars.update(ChunkIndex.vartoken.findall(w))
+			if c=='=':
+				j=w.find('(')
+				if j>=0:
+					name=w[2:j]
+					self.generators[i]=name
+					params.update(p.strip() for p in w[j+1:-1].split(','))
+				else:
+					(name,parent)=ChunkIndex.lastname(w[2:])
+					if parent: # .=a.b makes a named member of a
+						(pname,pp)=ChunkIndex.lastname(parent)
+						if pname: self.joiners.setdefault(pname,[]).append(i)
+						else: isfull=True
+					ChunkIndex.refnames(w[2:],exists)
+				if name: self.definers.setdefault(name,[]).append(i)
+				else: isfull=True
+			elif c=='$': isfull=True # prints a uid if it holds a node, and those differ from a full build
+			elif c=='<': ChunkIndex.refnames(w[2:],contents)
+			elif c=='-' or c=='+': ChunkIndex.refnames(w[2:],exists)
+			elif w.startswith('._join(') and w[-1]==')': # like the .xxx shorthand
+				(name,parent)=ChunkIndex.lastname(w[7:-1])
+				if name: self.joiners.setdefault(name,[]).append(i)
+				else: isfull=True
+				ChunkIndex.refnames(w[7:-1],contents if '(' in w[7:-1] else exists)
+			elif w.startswith(('._join(','._name(')): isfull=True # ._name names this chunk's node
+			elif c=='_' and not w.startswith(('._default','._literal(','._l(')):
+				if not w.startswith('._global'): ChunkIndex.refnames(w[2:],contents)
+			else:
+				j=findequals_parsenamestring(w)
+				if j<0:
+					(name,parent)=ChunkIndex.lastname(w[1:])
+					if name: self.joiners.setdefault(name,[]).append(i)
+					else: isfull=True
+					ChunkIndex.refnames(w[1:],contents if '(' in w else exists)
 				else:
-					raise ValueError('unhandled command: %s'%w)
+					ChunkIndex.refnames(w[1:j],exists)
+					if w[j+1:j+2]=='.': ChunkIndex.refnames(w[j+2:],contents)
+					else: contents.add('_literal')
+		if vars-params-{'_uid'}: isfull=True # a global string could name any node
+		for name in exists|contents: self.referrers.setdefault(name,[]).append(i)
+		if isfull: return None
+		return (exists,contents)
+	def select(self,exports,suppress=[]): # the chunks that exports and top-level suppressions need, in input order, None if only a full build is safe
+		need=[] # (name,ismembers)
+		for path in exports:
+			for part in re.split('[.:/]',path):
+				if part[:1]=='(' and part[-1:]==')': part=part[1:-1] # (_a) as well as _a
+				if part in ('_default','_all','_a'): return None # those show every chunk, or uids
+			names=set()
+			ChunkIndex.refnames(path,names)
+			need+=[(name,True) for name in names]
+		for path in suppress:
+			names=set()
+			ChunkIndex.refnames(path,names)
+			need+=[(name,False) for name in names]
+		chosen=set()
+		todo=[] # chosen chunks whose deps aren't needed yet
+		exists=set() # names whose definers are chosen
+		members=set() # names whose joiners are chosen too
+		while True:
+			if todo:
+				deps=self.deps[todo.pop()]
+				if deps==None: return None
+				need+=[(name,False) for name in deps[0]]
+				need+=[(name,True) for name in deps[1]]
+			elif need:
+				(name,ismembers)=need.pop()
+				if name not in exists:
+					exists.add(name)
+					for i in self.definers.get(name,()):
+						if i not in chosen:
+							chosen.add(i)
+							todo.append(i)
+				if ismembers and name not in members:
+					if name=='_default': return None # every chunk joins it
+					members.add(name)
+					for i in self.joiners.get(name,()):
+						if i not in chosen:
+							chosen.add(i)
+							todo.append(i)
+						g=self.generators.get(i)
+						if g:
+							for j in self.referrers.get(g,()):
+								if j not in chosen:
+									chosen.add(j)
+									todo.append(j)
+			else: break
+		return [self.chunks[i] for i in sorted(chosen)]
+
+def buildnodes(p0,issnapshot=False,exports=None,suppress=[]): # builds the graph of active chunks, or loads it from a snapshot
+	nodes=None
+	snapshotfn=None
+	if issnapshot:
+		if not p0.cachedir: errorout('--snapshot requires --cache-dir')
+		snapshotfn=p0.snapshotfilename()
+		nodes=Nodes.loadsnapshot(snapshotfn)
+	if not nodes:
+		chunks=p0.chunks
+		if exports!=None: # lazy, only what exporting these needs
+			lazychunks=ChunkIndex(chunks).select(exports,suppress)
+			if lazychunks!=None:
+				chunks=lazychunks
+				snapshotfn=None # a partial graph can't serve other exports
+		nodes=Nodes()
+		nodes.setglobalvars(p0.globalvars)
+		nodes.adddefaultnode()
+		nodes.addliteralnode()
+		nodes.addchunks(chunks)
+		if snapshotfn: nodes.savesnapshot(snapshotfn)
+	return nodes
+
+class Document():
+	def __init__(self,nodes):
+		self.nodes=nodes
+		self.maxdepth=0 # --max-depth, 0 for no limit, include cycles are caught either way
+		self.renderjobs=1 # --render-jobs, worker processes for the members of an export, see .exportparallel
+		self.renderhits=0 # nodes replayed from a RenderCache, over all exports
+		self.rendermisses=0
+	def stats(self): # counters for --stats
+		nodes=self.nodes
+		return {'pathhits':nodes.pathhits,'pathmisses':nodes.pathmisses,'pathcache':len(nodes.pathcache),
+			'renderhits':self.renderhits,'rendermisses':self.rendermisses,'chunks':len(nodes.chunknodes),'nodes':len(nodes.nodes)}
+	def printstats(self,fout):
+		st=self.stats()
+		n=st['pathhits']+st['pathmisses']
+		fout.write('path cache: %s hits, %s misses, %.1f%% hit rate, %s entries\n'%(st['pathhits'],st['pathmisses'],100.0*st['pathhits']/n if n else 0,st['pathcache']))
+		n=st['renderhits']+st['rendermisses']
+		fout.write('render cache: %s hits, %s misses, %.1f%% hit rate\n'%(st['renderhits'],st['rendermisses'],100.0*st['renderhits']/n if n else 0))
+		fout.write('built: %s chunks, %s nodes\n'%(st['chunks'],st['nodes']))
+	def getpreoutput(self,fout,mode=None,isforce=None):
+		globalvars=self.nodes.globalvars
+		if mode:
+			globalvars=globalvars.clone()
+			globalvars.setvar('_escapesmode',mode)
+		return PreOutput(globalvars,fout,isforce)
+	def export(self,fout,exports,suppress=[],mode=None,isforce=None): # writes to fout, returns the PreOutput
+		po=self.getpreoutput(fout,mode,isforce)
+		self.exportto(po,exports,suppress)
+		return po
+	def exportto(self,po,exports,suppress=[]): # po can be a PreOutput or PreOutputs
+		nodes=self.nodes
+		suppressions=Suppressions()
+		for path in suppress:
+			suppressions.addpath(nodes,path,False)
+		memo=RenderCache(po)
+		isgc=gc.isenabled()
+		gc.disable() # as in Nodes.addchunks, each plan compiled by Node.export would make the collector rescan the graph
+		try:
+			for path in exports:
+				(node,relt)=nodes.path_findname(path,None,0)
+				if relt==0:
+					relt=3 if node.components else 1
+				if relt==2:
+					node.dump()
+				elif self.renderjobs>1 and relt>2 and len(node.members(relt))>1 and cpucount()>1 and self.exportparallel(po,node,relt,suppressions,memo):
+					pass
+				else:
+					node.export(nodes,suppressions,po,self.maxdepth,relt,memo=memo)
+		finally:
+			if isgc: gc.enable()
+			self.renderhits+=memo.hits
+			self.rendermisses+=memo.misses
+			po.finalize() # output before an error is still written
+	def exportparallel(self,po,node,relt,suppressions,memo): # node.export() with runs of its members rendered by worker processes, False if they can't be forked
+		import multiprocessing,concurrent.futures # only loaded when needed, they're slow to import
+		if 'fork' not in multiprocessing.get_all_start_methods(): return False # workers inherit the document and the suppressions
+		members=node.members(relt)
+		jobs=min(self.renderjobs,len(members))
+		size=-(-len(members)//(jobs*4)) # a few runs per worker evens out their load
+		runs=[(start,min(start+size,len(members))) for start in range(0,len(members),size)]
+		global forkexport_global
+		forkexport_global=(self,node,relt,suppressions)
+		ctx=multiprocessing.get_context('fork')
+		staticruns={}
+		try:
+			with concurrent.futures.ProcessPoolExecutor(jobs,mp_context=ctx) as pool:
+				for data in pool.map(forked_exportmembers,runs): # in order, while later runs are still rendering
+					(calls,hits,misses)=marshal.loads(data)
+					memo.hits+=hits
+					memo.misses+=misses
+					Segment.replay(calls,po,staticruns)
+		finally: forkexport_global=None
+		return True
+	def exportfile(self,files,exports,suppress=[],isforce=None): # files: [(filename,mode),...], written from one traversal
+		fouts=[]
+		try:
+			pos=[]
+			for fn,mode in files:
+				f=open(fn,'w')
+				fouts.append(f)
+				pos.append(self.getpreoutput(f,mode,isforce))
+			self.exportto(PreOutputs(pos),exports,suppress)
+			for f,po in zip(fouts,pos):
+				if po.isbrokenline: f.write('\n')
+		finally:
+			for f in fouts: f.close()
+	def exportfiles(self,outs,suppress=[],isforce=None,jobs=1): # outs: [(path,filename,mode),...], each gets its own suppressions and runtime vars
+		groups={} # path -> [(filename,mode),...], a path is only traversed once
+		for path,fn,mode in outs:
+			groups.setdefault(path,[]).append((fn,mode))
+		args=[(files,[path],suppress,isforce) for path,files in groups.items()]
+		if jobs>1 and len(args)>1:
+			import multiprocessing,concurrent.futures # only loaded when needed, they're slow to import
+			if 'fork' in multiprocessing.get_all_start_methods(): # workers inherit the built document
+				global forkdoc_global
+				forkdoc_global=self
+				ctx=multiprocessing.get_context('fork')
+				try:
+					with concurrent.futures.ProcessPoolExecutor(min(jobs,len(args)),mp_context=ctx) as pool:
+						for r in pool.map(forked_exportfile,args): pass
+				finally: forkdoc_global=None
+				return
+		for a in args:
+			self.exportfile(*a)
+	def render(self,exports,suppress=[],mode=None,isforce=None): # mode None uses the document's _escapesmode
+		fout=io.StringIO()
+		self.export(fout,exports,suppress,mode,isforce)
+		return fout.getvalue()
+
+forkdoc_global=None # Document for forked Document.exportfiles workers
+
+def forked_exportfile(args):
+	forkdoc_global.renderjobs=1 # pool workers can't start pools of their own
+	forkdoc_global.exportfile(*args)
+
+forkexport_global=None # (Document,node,relt,Suppressions) for forked Document.exportparallel workers
+
+def forked_exportmembers(run): # renders members start:end of the export, returns marshal data of its calls for Segment.replay
+	(doc,node,relt,suppressions)=forkexport_global
+	(start,end)=run
+	seg=Segment()
+	memo=RenderCache(seg)
+	node.export(doc.nodes,suppressions,seg,doc.maxdepth,relt,memo=memo,members=node.members(relt)[start:end])
+	return marshal.dumps((seg.calls,memo.hits,memo.misses))
+
+def cpucount(): # CPUs this process may run on
+	if hasattr(os,'sched_getaffinity'): return len(os.sched_getaffinity(0))
+	return os.cpu_count() or 1
+
+forkbufs_global=None # input buffers for forked Phase0.addfiles workers
+
+def forked_splitchunks(args): # returns marshal data, it's much quicker to send back than a pickle
+	(i,start,end)=args
+	return marshal.dumps(Phase0.splitchunks(forkbufs_global[i],start,end))
+
+def load(files,vars=[],escapesmode='html',cachedir=None,issnapshot=False,exports=None,suppress=[],jobs=1): # exports: build lazily, only for these
+	return Document(buildnodes(loadphase0(files,vars,escapesmode,cachedir,jobs),issnapshot,exports,suppress))
+
+class Server(): # renders requests over a unix socket, one json object per line each way
+	maxdocs=16 # built documents kept, one per distinct (vars,mode)
+	def __init__(self,files,cachedir=None):
+		self.files=files
+		self.cachedir=cachedir
+		self.mtimes=[None]*len(files)
+		self.sources=[None]*len(files) # (buf,chunks) for each file
+		self.docs={}
+		self.stale=set() # keys of docs built from older sources
+	def checkfiles(self): # rereads changed files, returns True if anything changed
+		ischanged=False
+		p0=newphase0([],'html',self.cachedir)
+		for i,fn in enumerate(self.files):
+			mtime=os.stat(fn).st_mtime_ns
+			if mtime==self.mtimes[i]: continue
+			buf=Phase0.readfile(fn)
+			self.sources[i]=(buf,p0.parsebuf(buf))
+			self.mtimes[i]=mtime
+			ischanged=True
+		if ischanged: self.stale.update(self.docs)
+		return ischanged
+	def getdocument(self,vars,mode):
+		key=(tuple(vars),mode)
+		doc=self.docs.get(key)
+		if doc and key not in self.stale: return doc
+		p0=newphase0(vars,mode)
+		for buf,chunks in self.sources:
+			p0.addchunks(buf,chunks)
+		p0.process()
+		self.docs.pop(key,None) # in case the build fails
+		self.stale.discard(key)
+		if not doc or not doc.nodes.update(p0):
+			doc=Document(buildnodes(p0))
+		if len(self.docs)>=Server.maxdocs: del self.docs[next(iter(self.docs))]
+		self.docs[key]=doc
+		return doc
+	def request(self,req): # req: {exports,suppress,vars,mode,isforce}
+		self.checkfiles()
+		doc=self.getdocument(req.get('vars',[]),req.get('mode') or 'html')
+		exports=req.get('exports') or ['mainmenu']
+		fout=io.StringIO()
+		po=doc.export(fout,exports,req.get('suppress',[]),None,req.get('isforce'))
+		return {'output':fout.getvalue(),'isbrokenline':po.isbrokenline}
+	async def handle(self,reader,writer):
+		while True:
+			line=await reader.readline()
+			if not line: break
+			try: resp=self.request(json.loads(line))
+			except (MsetError,ValueError,OSError) as e: resp={'error':str(e)}
+			except Exception as e: resp={'error':'Error: %s: %s'%(e.__class__.__name__,e)} # a bug, but the client still gets an answer and the server goes on
+			writer.write(json.dumps(resp).encode()+b'\n')
+			await writer.drain()
+		writer.close()
+	async def serve(self,path):
+		import asyncio
+		server=await asyncio.start_unix_server(self.handle,path)
+		async with server: await server.serve_forever()
+	def run(self,path):
+		import asyncio # not imported at the top, it's slow to load and only needed here
+		self.checkfiles()
+		if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode): os.remove(path)
+		try: asyncio.run(self.serve(path))
+		except KeyboardInterrupt: pass
+		finally: os.remove(path)
+
+def client(path,req): # sends one request to a --serve process, returns the response
+	s=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+	s.connect(path)
+	s.sendall(json.dumps(req).encode()+b'\n')
+	with s.makefile('rb') as f: line=f.readline()
+	s.close()
+	if not line: errorout('No response from %s'%path)
+	return json.loads(line)
 
 def printusage():
 	print('Usage: mset.py INFILE [+flag] [--option] [.nodename]')
-	print('Options: --html, --xhtml --text --force --p0dump -gvdump --nodesdump --namesdump --debug')
+	print('Options: --html, --xhtml --text --force --p0dump -gvdump --nodesdump --namesdump --debug --cache-dir=DIR --snapshot --serve=SOCKET --client=SOCKET --out=.nodename=FILE --jobs=N --stats --max-depth=N --lazy --render-jobs=N')
 	exit(0)
 
-if False:
-	text='._join(.a.b.c)'
-	w=Word.loadword(text,None)
-	print('text:',text,'w:',w)
-	exit(0)
+def main(argv=None):
+	global isdebug_global
+	if argv==None: argv=sys.argv
+	exports=[]
+	topsuppressions=[]
+	infiles=[]
+	vars=[]
+	cachedir=None
+	p0_dump=False
+	gv_dump=False
+	nodes_dump=False
+	names_dump=False
+	isforce=None
+	issnapshot=False
+	servepath=None
+	clientpath=None
+	escapesmode=None
+	outs=[]
+	jobs=1
+	isstats=False
+	maxdepth=0
+	islazy=False
+	renderjobs=1
+
+	if 1==len(argv): printusage()
 
-exports=[]
-topsuppressions=[]
-p0=Phase0()
-p0.setvarcmd('._globalstring(_escapesmode,html)')
-p0_dump=False
-gv_dump=False
-nodes_dump=False
-names_dump=False
-isforce=None
-
-if 1==len(sys.argv): printusage()
-
-for arg in sys.argv[1:]:
-	if arg.startswith('--'):
-		if arg=='--html': p0.setvarcmd('._globalstring(_escapesmode,html)')
-		if arg=='--xhtml': p0.setvarcmd('._globalstring(_escapesmode,xhtml)')
-		elif arg=='--text': p0.setvarcmd('._globalstring(_escapesmode,text)')
-		elif arg=='--force': isforce=True
-		elif arg=='--p0dump': p0_dump=True
-		elif arg=='--gvdump': gv_dump=True
-		elif arg=='--nodesdump': nodes_dump=True
-		elif arg=='--namesdump': names_dump=True
-		elif arg=='--debug': isdebug_global=True
-		elif arg=='--help': printusage()
+	for arg in argv[1:]:
+		if arg.startswith('--'):
+			if arg=='--html': escapesmode='html'
+			elif arg=='--xhtml': escapesmode='xhtml'
+			elif arg=='--text': escapesmode='text'
+			elif arg=='--force': isforce=True
+			elif arg=='--p0dump': p0_dump=True
+			elif arg=='--gvdump': gv_dump=True
+			elif arg=='--nodesdump': nodes_dump=True
+			elif arg=='--namesdump': names_dump=True
+			elif arg=='--debug': isdebug_global=True
+			elif arg.startswith('--cache-dir='): cachedir=arg[12:]
+			elif arg=='--snapshot': issnapshot=True
+			elif arg.startswith('--serve='): servepath=arg[8:]
+			elif arg.startswith('--client='): clientpath=arg[9:]
+			elif arg.startswith('--out='):
+				j=arg.find('=',6)
+				if not arg.startswith('--out=.') or j<0: raise ValueError("Expected --out=.nodename=filename, got %s"%arg)
+				path=arg[7:j]
+				outs.append((path or '_default',arg[j+1:],escapesmode)) # the last --html/--xhtml/--text before it
+			elif arg.startswith('--jobs='): jobs=int(arg[7:])
+			elif arg=='--stats': isstats=True
+			elif arg.startswith('--max-depth='): maxdepth=int(arg[12:])
+			elif arg=='--lazy': islazy=True
+			elif arg.startswith('--render-jobs='): renderjobs=int(arg[14:])
+			elif arg=='--help': printusage()
+			else:
+				raise ValueError("Unknown argument %s"%arg)
+		elif arg.startswith('+'):
+			vars.append(arg[1:])
+		elif arg.startswith('.'):
+			if arg=='.': exports.append('_default')
+			elif arg.startswith('.-'):
+				topsuppressions.append(arg[2:])
+			else: exports.append(arg[1:])
 		else:
-			raise ValueError("Unknown argument %s"%arg)
-	elif arg.startswith('+'):
-		p0.globalvars.setvarparse(arg[1:])
-	elif arg.startswith('.'):
-		if arg=='.': exports.append('_default')
-		elif arg.startswith('.-'):
-			topsuppressions.append(arg[2:])
-		else: exports.append(arg[1:])
-	else:
-		p0.addfile(arg)
-p0.collectvars()
-p0.process()
-
-if not exports: exports.append('mainmenu')
-
-if p0_dump:
-	p0.dump()
-	exit(0)
+			infiles.append(arg)
 
-# now all input is processed and conditional inclusion has been done
+	try:
+		if servepath:
+			Server(infiles,cachedir).run(servepath)
+			return
+		if clientpath:
+			resp=client(clientpath,{'exports':exports,'suppress':topsuppressions,'vars':vars,'mode':escapesmode,'isforce':isforce})
+			if 'error' in resp: raise MsetError(resp['error'])
+			print(resp['output'],end='')
+			if resp['isbrokenline']: print()
+			return
 
-nodes=Nodes()
-nodes.setglobalvars(p0.globalvars)
-if gv_dump:
-	print('Globalvars:',nodes.globalvars.vars)
-	exit(0)
-defaultnode=nodes.adddefaultnode()
-nodes.addliteralnode()
-for chunk in p0.chunks:
-	if not chunk.isactive: continue
-	node=nodes.lines_addnode(chunk.words,chunk.lines)
-	if not node.ismarked:
-		defaultnode.addcomponent(node)
-
-if nodes_dump:
-	nodes.nodes_dump()
-	exit(0)
+		p0=loadphase0(infiles,vars,escapesmode or 'html',cachedir,jobs)
 
-if names_dump:
-	nodes.names_dump()
-	exit(0)
+		if not exports and not outs: exports.append('mainmenu')
+
+		if p0_dump:
+			p0.dump()
+			exit(0)
+
+		# now all input is processed and conditional inclusion has been done
+
+		if gv_dump:
+			print('Globalvars:',p0.globalvars.vars)
+			exit(0)
+
+		lazyexports=None
+		if islazy and not nodes_dump and not names_dump: lazyexports=exports+[path for path,fn,mode in outs]
+		doc=Document(buildnodes(p0,issnapshot,lazyexports,topsuppressions))
+		if issnapshot: gc.freeze() # the graph lives until exit, keep later collections from rescanning it
+		doc.maxdepth=maxdepth
+		doc.renderjobs=renderjobs
+
+		if nodes_dump:
+			doc.nodes.nodes_dump()
+			exit(0)
+
+		if names_dump:
+			doc.nodes.names_dump()
+			exit(0)
+
+		if outs: doc.exportfiles(outs,topsuppressions,isforce,jobs)
+		if exports:
+			po=doc.export(sys.stdout,exports,topsuppressions,None,isforce)
+			if po.isbrokenline: print()
+		if isstats: doc.printstats(sys.stderr)
+	except MsetError as e:
+		if isdebug_global: raise
+		print(e)
+		exit(-1)
 
-po=PreOutput(nodes.globalvars,sys.stdout)
-
-suppressions=Suppressions()
-for path in topsuppressions:
-	suppressions.addpath(nodes,path,False)
-for path in exports:
-	(node,relt)=nodes.path_findname(path,None,0)
-	if relt==0:
-		relt=3 if node.components else 1
-	if relt==2:
-		node.dump()
-	else:
-		node.export(nodes,suppressions,po,10,relt)
-po.finalize(isforce)
-if po.isbrokenline: print()
+if __name__=='__main__':
+	main()
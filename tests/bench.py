@@ -0,0 +1,162 @@
+# Benchmarks behind the timings in the commit log, not collected by pytest
+# python tests/bench.py [--dir=DIR] [--scale=F] [user-001 ...]: writes the generated inputs into DIR (a temporary directory by default) and prints timings, --scale shrinks or grows them
+import os,re,sys,time,glob,random,shutil,tempfile,tracemalloc
+root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,root) # mset.py is in the repository root
+import mset
+
+benches=[] # (request id,function), in backlog order
+def bench(f): # bench_user_001 runs as user-001
+	benches.append((f.__name__[6:].replace('_','-'),f))
+	return f
+
+def timed(f,reps=3): # best of reps, and the last result
+	dt=None
+	for r in range(reps):
+		t=time.perf_counter(); res=f(); t=time.perf_counter()-t
+		if dt==None or t<dt: dt=t
+	return dt,res
+
+def write(d,name,lines): # kept if a run with the same --dir and sizes already wrote it
+	fn=os.path.join(d,name)
+	if not os.path.exists(fn):
+		with open(fn,'w') as f: f.write('\n'.join(lines)+'\n')
+	return fn
+
+def taxes(d,rows): # examples/taxes.fancy.txt with rows more ledger rows after its own, load with +html
+	src=open(os.path.join(root,'examples','taxes.fancy.txt')).read().split('\n')
+	insts=['ms','boa','wf','ml']; buckets=['interest','dividends','qualified','nontax']
+	add=['. .%s .inst=.%s .price=(%d.%02d) .desc=(row %d) .%s ._include(.onerow(.$_uid))'%(insts[i%4],insts[i%4],i%97,i%100,i,buckets[i%4]) for i in range(rows)]
+	return write(d,'tax%d.txt'%rows,src[:40]+add+src[40:])
+
+def book(d,chapters,paras): # chapters named in one chunk, then paras paragraphs of random words and escapes spread over them
+	r=random.Random(1); words=['the','cat','sat','on','mat','\\bold','\\Bold','\\n']
+	lines=['. .=ch%d Chapter %d'%(i,i) for i in range(chapters)]
+	for i in range(paras): lines+=['','.ch%d '%r.randrange(chapters)+' '.join(r.choice(words) for k in range(30))]
+	return write(d,'book%dx%d.txt'%(chapters,paras),lines)
+
+def bookp(d,chapters,paras): # a .chapters export of chapters that each include their paragraphs, with runtime counters
+	r=random.Random(1); words=['the','cat','sat','on','mat','\\bold','\\Bold','\\n']
+	lines=['.=chapters Chapters','','. .=head .chapters Start ._set(words) ._set(paras)','']
+	for i in range(chapters):
+		lines+=['. .=ch%d .chapters \\Paragraph Chapter %d ._sum(words,1) .<ch%d.(_c)'%(i,i,i),'']
+		for k in range(paras): lines+=['.ch%d '%i+' '.join(r.choice(words) for k in range(30))+' ._sum(paras,1)','']
+	lines.append('. .=tail .chapters total ._printvar(paras) paras ._assert(paras)')
+	return write(d,'bookp%dx%d.txt'%(chapters,paras),lines)
+
+@bench
+def bench_user_001(d,n): # tokenizer: Phase0.parseline over the examples and over long synthetic lines
+	lines=[l.rstrip('\n') for fn in sorted(glob.glob(os.path.join(root,'examples','*.txt'))) for l in open(fn)]*n(200)
+	for k in (50,200,800):
+		lines.append('. '+' '.join('.row%d word%d \\Bold bold%d \\bold ._l(x%d)'%(i,i,i,i) for i in range(k)))
+	for name,data in (('examples x%d'%n(200),lines[:-3]),('synthetic',lines[-3:]*n(20))):
+		dt,words=timed(lambda:sum(len(mset.Phase0.parseline(l)) for l in data))
+		print('  parseline %s: %d words %.3fs %.0f words/s'%(name,words,dt,words/dt))
+
+@bench
+def bench_user_004(d,n): # --cache-dir: phase 0 of a big ledger uncached, with a cold cache and with a warm one
+	fn=taxes(d,n(30000)); cachedir=os.path.join(d,'cache')
+	shutil.rmtree(cachedir,ignore_errors=True)
+	for name,cd in (('uncached',None),('cold',cachedir),('warm',cachedir)):
+		t=time.perf_counter(); p0=mset.loadphase0([fn],['html'],'html',cd); t=time.perf_counter()-t
+		print('  loadphase0 %s, %s: %d chunks %.3fs'%(os.path.basename(fn),name,len(p0.chunks),t))
+
+@bench
+def bench_user_012(d,n): # Word slots: peak memory while building
+	for fn,vars in ((taxes(d,n(5000)),['html']),(book(d,100,n(10000)),[])):
+		tracemalloc.start()
+		t=time.perf_counter(); mset.load([fn],vars); t=time.perf_counter()-t
+		peak=tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+		print('  load %s: peak %.1fMB, %.2fs traced'%(os.path.basename(fn),peak/1e6,t))
+
+@bench
+def bench_user_014(d,n): # generator instantiation plans: building 100k generated ledger rows
+	fn=taxes(d,n(100000))
+	t=time.perf_counter(); doc=mset.load([fn],['html']); t=time.perf_counter()-t
+	made=sum(1 for node in doc.nodes.nodes if node.generation and not node.generation.isgenerator)
+	print('  load %s: %d generated nodes %.2fs'%(os.path.basename(fn),made,t))
+
+@bench
+def bench_user_016(d,n): # adopt indexes: 100 groups over 100k members, then 1k supersets that each adopt 10 random groups
+	r=random.Random(1); members=n(100000); supers=n(1000)
+	lines=[]
+	for g in range(100): lines+=['.=gr%d Group%d'%(g,g),'']
+	for i in range(members): lines+=['. .=m%d mem%d .gr%d'%(i,i,r.randrange(100)),'']
+	plain=write(d,'adopt%d.txt'%members,lines)
+	for i in range(supers): lines+=['.=su%d Super '%i+' '.join('._adopt(.gr%d)'%r.randrange(100) for k in range(10)),'']
+	for fn in (plain,write(d,'adopt%dx%d.txt'%(members,supers),lines)):
+		t=time.perf_counter(); mset.load([fn],[],'text'); t=time.perf_counter()-t
+		print('  load %s: %.2fs'%(os.path.basename(fn),t))
+
+@bench
+def bench_user_019(d,n): # iterative export: deep and wide include trees, a ledger report and a long include chain
+	def tree(name,levels,fanout,doubled): # only the innermost doubled levels fan out, each node is defined before its includers
+		lines=['.=%s%d leaf'%(name,levels-1),'']
+		for i in range(levels-2,-1,-1): lines+=['.=%s%d '%(name,i)+' '.join(['._include(.%s%d)'%(name,i+1)]*(fanout if i>=levels-1-doubled else 1)),'']
+		return write(d,'%s%dx%dx%d.txt'%(name,levels,fanout,doubled),lines)
+	cases=[(tree('t',50,2,n(20)),[],'t0'),(tree('w',10,5,min(9,n(9))),[],'w0'),(taxes(d,n(20000)),['html'],'report'),(tree('c',n(5000),1,0),[],'c0')]
+	for fn,vars,name in cases:
+		doc=mset.load([fn],vars,'text')
+		dt,out=timed(lambda:doc.render([name]))
+		print('  export .%s of %s: %d chars %.3fs'%(name,os.path.basename(fn),len(out),dt))
+
+@bench
+def bench_user_022(d,n): # conditional inclusion: 100k conditional chunks over 1k flags, set at the end, each conditional on the previous one
+	r=random.Random(1); flags=n(1000); lines=[]
+	for i in range(n(100000)): lines+=['. .?%sf%d c%d text'%(r.choice(['','-']),r.randrange(flags),i),'']
+	for k in range(flags): lines+=['. .?f%d ._globalint(f%d,1)'%(k-1,k) if k else '. ._globalint(f0,1)','']
+	fn=write(d,'cond%dx%d.txt'%(n(100000),flags),lines)
+	def process():
+		p0=mset.newphase0([],'text'); p0.addfile(fn)
+		t=time.perf_counter(); p0.process()
+		return time.perf_counter()-t,p0
+	dt,p0=min((process() for r in range(5)),key=lambda res:res[0])
+	print('  process %s: %d active chunks, %d of %d flags set %.3fs'%(os.path.basename(fn),sum(chunk.isactive for chunk in p0.chunks),sum(p0.globalvars.istrue('f%d'%k) for k in range(flags)),flags,dt))
+
+@bench
+def bench_user_024(d,n): # --render-jobs: the .chapters export of 300 chapters of 30 paragraphs with 1 to 8 workers
+	fn=bookp(d,n(300),30); doc=mset.load([fn],[],'text')
+	print('  cpucount() is %d, the parallel path is forced either way'%mset.cpucount())
+	cpucount=mset.cpucount; mset.cpucount=lambda:8
+	try:
+		for jobs in (1,2,4,8):
+			doc.renderjobs=jobs
+			dt,out=timed(lambda:doc.render(['chapters']),5)
+			if jobs==1: serial=(dt,out)
+			print('  export .chapters of %s, %d workers: %.3fs x%.2f%s'%(os.path.basename(fn),jobs,dt,serial[0]/dt,'' if out==serial[1] else ', output differs'))
+	finally: mset.cpucount=cpucount
+
+@bench
+def bench_user_025(d,n): # render plans: first, second and later exports of examples/story.txt scaled 1000x and of the book above
+	src=open(os.path.join(root,'examples','story.txt')).read()
+	names=sorted(set(re.findall(r'\.=([\w,]+)',src)),key=len,reverse=True)
+	pat=re.compile(r'(?<=[.=<(])(%s)(?=[\s)]|$)'%'|'.join(map(re.escape,names)),re.M)
+	copies=n(1000)
+	lines=[pat.sub(lambda m:m.group(1)+'x%d'%k,src) for k in range(copies)] # names suffixed per copy
+	lines.append('.=book '+' '.join('.<chaptersx%d'%k for k in range(copies)))
+	story=write(d,'story%d.txt'%copies,['\n\n'.join(lines)])
+	for fn,name in ((story,'book'),(bookp(d,n(300),30),'chapters')):
+		for mode in ('html','text'):
+			doc=mset.load([fn],[],mode); times=[]
+			for r in range(2): # the second export compiles the plans
+				t=time.perf_counter(); doc.render([name]); times.append(time.perf_counter()-t)
+			later,out=timed(lambda:doc.render([name]))
+			print('  export .%s of %s, %s: first %.3fs second %.3fs later %.3fs'%(name,os.path.basename(fn),mode,times[0],times[1],later))
+
+def main(argv):
+	d=None; scale=1.0; names=[]
+	for arg in argv[1:]:
+		if arg.startswith('--dir='): d=arg[6:]
+		elif arg.startswith('--scale='): scale=float(arg[8:])
+		elif arg.startswith('-'): raise ValueError("Expected --dir=DIR, --scale=F or request ids, got %s"%arg)
+		else: names.append(arg)
+	n=lambda k:max(1,int(k*scale))
+	tmp=None
+	if d==None: tmp=tempfile.TemporaryDirectory(); d=tmp.name
+	else: os.makedirs(d,exist_ok=True)
+	for name,f in benches:
+		if names and name not in names: continue
+		print('%s:'%name); f(d,n)
+	if tmp: tmp.cleanup()
+
+if __name__=='__main__': main(sys.argv)
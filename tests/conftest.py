@@ -0,0 +1,2 @@
+import os,sys
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # mset.py is in the repository root
@@ -0,0 +1,19 @@
+# ._adopt: adopting the members of a node that has the adopter among them makes it a member of itself, as it always did
+import pytest
+import mset
+
+text='.=n0 A\n\n.=n1 text1 .n0 ._adopt(.n0)\n\n.=n2 two .n0\n'
+
+def test_adopt_own_container(tmp_path):
+	fn=tmp_path/'a.txt'
+	fn.write_text(text)
+	doc=mset.load([str(fn)],[],'text')
+	assert doc.render(['n1']).split()==['text1']
+	assert doc.render(['n0']).split()==['text1','two']
+	assert doc.render(['n1.(_c)']).split()==['text1']
+	assert [n.uid for n in doc.nodes.nodesbyname['n1'].components]==[doc.nodes.nodesbyname['n1'].uid]
+
+def test_cycle(tmp_path): # exporting its own members then never ends
+	fn=tmp_path/'a.txt'
+	fn.write_text('.=n0 A\n\n.=n1 text1 .n0 ._adopt(.n0) .<n1.(_c)\n')
+	with pytest.raises(mset.MsetError,match='Recursion cycle'): mset.load([str(fn)],[],'text').render(['n1'])
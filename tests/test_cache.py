@@ -0,0 +1,32 @@
+# --cache-dir: cached chunks give the same document as parsing, unusable cache files are parsed again
+import marshal,os
+import mset
+
+text='.=top Top \\Bold words\n\n.top more (words) .=x\n\n. .?-flag .top flagged\n'
+
+def phase0(dirname):
+	return mset.newphase0([],'text',dirname)
+
+def chunks(p0):
+	return [(c.words,c.lines.getlines(),c.isactive) for c in p0.chunks]
+
+def test_roundtrip(tmp_path):
+	a=phase0(None)
+	a.addchunks(text,a.parsebuf(text))
+	for _ in range(2): # the first one writes the cache, the second reads it
+		b=phase0(str(tmp_path))
+		b.addchunks(text,b.parsebuf(text))
+		assert chunks(b)==chunks(a)
+	assert len(os.listdir(tmp_path))==1
+
+def test_wrong_shape(tmp_path):
+	a=phase0(None)
+	a.addchunks(text,a.parsebuf(text))
+	fn=phase0(str(tmp_path)).cachefilename(text)
+	for data in (b'garbage',marshal.dumps(1),marshal.dumps([1]),marshal.dumps([[1,2]]),marshal.dumps([[['a'],[0]]]),
+			marshal.dumps([[[1],[0,1]]]),marshal.dumps([[['a'],['0','1']]]),marshal.dumps([(['a'],[0,1])])):
+		with open(fn,'wb') as f: f.write(data)
+		b=phase0(str(tmp_path))
+		b.addchunks(text,b.parsebuf(text))
+		assert chunks(b)==chunks(a),data
+		with open(fn,'rb') as f: assert marshal.load(f)==phase0(None).parsebuf(text) # and rewritten
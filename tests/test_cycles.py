@@ -0,0 +1,28 @@
+# Node.export: including a node again is only a cycle if the suppressions are also the same, --max-depth bounds it instead
+import pytest
+import mset
+
+def document(tmp_path,text,maxdepth=0):
+	fn=tmp_path/'c.txt'
+	fn.write_text(text)
+	doc=mset.load([str(fn)],[],'text')
+	doc.maxdepth=maxdepth
+	return doc
+
+def test_stops_by_itself(tmp_path): # sec comes back with grp's components, itself, suppressed
+	for maxdepth in (0,50):
+		doc=document(tmp_path,'.=top Top\n\n.=grp Grp\n\n.=sec .top .grp Sec ._suppress(.grp) .<top\n',maxdepth)
+		assert doc.render(['top']).split()==['Sec']
+
+@pytest.mark.parametrize('text',['.=loop L .<loop\n',
+	'.=aa A\n\n.=loop L ._unsuppress(.aa) ._suppress(.aa) .<loop\n', # the same set again, after changes
+	'.=top Top\n\n.=sec .top Sec .<top\n'])
+def test_cycle(tmp_path,text):
+	for maxdepth in (0,50): # reported either way
+		with pytest.raises(mset.MsetError,match='Recursion cycle'): document(tmp_path,text,maxdepth).render(['loop' if 'loop' in text else 'top'])
+
+def test_maxdepth(tmp_path):
+	text='.=n30 End\n'+''.join('\n.=n%d N%d .<n%d\n'%(i,i,i+1) for i in range(29,-1,-1)) # includes only reach back
+	assert document(tmp_path,text).render(['n0']).split()[-1]=='End'
+	assert document(tmp_path,text,40).render(['n0']).split()[-1]=='End'
+	with pytest.raises(mset.MsetError,match='Recursion depth too high'): document(tmp_path,text,20).render(['n0'])
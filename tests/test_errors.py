@@ -0,0 +1,11 @@
+# bad input is reported as an MsetError, not as a traceback from some other exception
+import os
+import pytest
+import mset
+
+example=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'examples','example-3.txt')
+
+@pytest.mark.parametrize('exports,suppress',[([''],[]),(['story'],[''])])
+def test_empty_path(exports,suppress):
+	doc=mset.load([example],[],'text')
+	with pytest.raises(mset.MsetError,match='empty path'): doc.render(exports,suppress)
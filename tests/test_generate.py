@@ -0,0 +1,14 @@
+# generated nodes are keyed by their parameters as text, a literal 4 and node #4 (n4 here) are one generated node
+import contextlib,io
+import mset
+
+def test_literal_and_uid(tmp_path):
+	fn=tmp_path/'g.txt'
+	fn.write_text('.=n3 Three\n\n.=n4 Four\n\n.=g(a) G .$a\n\n.=top .<g(4) .<g(.n4)\n')
+	doc=mset.load([str(fn)],[],'text')
+	assert doc.nodes.nodesbyname['n4'].uid==4
+	assert doc.render(['top']).split()==['G','4','G','4']
+	assert len([name for name in doc.nodes.nodesbyname if type(name) is not str])==1
+	f=io.StringIO()
+	with contextlib.redirect_stdout(f): doc.nodes.names_dump()
+	assert f.getvalue().splitlines()[-1]=="(g)(4) (<class 'str'>)"
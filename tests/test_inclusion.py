@@ -0,0 +1,27 @@
+# Phase0.process: a chunk is decided after every chunk setting a variable it depends on, cycles in input order
+import mset
+
+def kept(text,vars=[]): # the names of the chunks conditional inclusion keeps
+	p0=mset.newphase0(vars,'text')
+	p0.addchunks(text,mset.Phase0.splitchunks(text))
+	p0.process()
+	return [chunk.words[0][2:] for chunk in p0.chunks if chunk.isactive]
+
+def test_flag_set_late():
+	text='.=xx .?flag X\n\n.=go ._globalint(go,1)\n\n.=yy .?go ._globalint(flag,1) Y\n'
+	assert kept(text)==['xx','go','yy'] # yy is decided after go, xx after yy
+	assert kept(text.replace('.=go ._globalint(go,1)','.=go Go'))==['go']
+	assert kept('.=gg .?-flag G\n\n.=hh H ._globalint(flag,1)\n')==['hh']
+
+def test_cycle_in_input_order():
+	aa='.=aa .?-fb ._globalint(fa,1) A\n'
+	bb='.=bb .?-fa ._globalint(fb,1) B\n'
+	assert kept(aa+'\n'+bb)==['aa']
+	assert kept(bb+'\n'+aa)==['bb']
+	assert kept(aa+'\n'+bb,['fa'])==['aa'] # +fa is set before anything is decided
+
+def test_name_set_to_zero_later():
+	text='.=nn N\n\n.=mm .?go M ._global0(nn)\n'
+	assert kept(text)==['nn']
+	assert kept(text,['go'])==['mm']
+	assert kept('.=nn N\n\n.=mm M ._global0(nn)\n')==['mm']
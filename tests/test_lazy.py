@@ -0,0 +1,76 @@
+# --lazy: building only the chunks that the exports need gives the same output as a full build
+import contextlib,io,random
+import mset
+
+def render(fn,exports,suppress,islazy): # and what it printed, (_a) dumps nodes to stdout
+	f=io.StringIO()
+	try:
+		with contextlib.redirect_stdout(f):
+			p0=mset.loadphase0([fn],[],'text')
+			return mset.Document(mset.buildnodes(p0,False,exports if islazy else None,suppress)).render(exports,suppress)+f.getvalue()
+	except mset.MsetError as e: return str(e)
+
+def check(fn,exports,suppress=[]):
+	a=render(fn,exports,suppress,False)
+	if a.startswith('Error'): return False # lazy builds skip the errors of unreached chunks
+	assert render(fn,exports,suppress,True)==a,(exports,suppress)
+	return True
+
+def gendoc(r): # (lines,names) of a random document with paths, maps, joins, generators and suppressions
+	lines=['.=dim Dim','']
+	defs=[]
+	gens=[]
+	for i in range(r.randint(3,30)):
+		ws=[]
+		if r.random()<0.15 and i>2:
+			g='g%d'%i
+			ws.append('.=%s(a,b)'%g)
+			gens.append(g)
+			ws+=r.sample(['T%d'%i,'._include(.$a)','._unmap(.$b,.dim)','.%s'%r.choice(defs),'.<%s'%r.choice(defs),'word','.$a'],3)
+		else:
+			name='n%d'%i
+			if defs and r.random()<0.2: ws.append('.=%s.%s'%(r.choice(defs),name))
+			else: ws.append('.=%s'%name)
+			ws.append('text%d'%i)
+			for _ in range(r.randint(0,3)):
+				if not defs: break
+				c=r.random()
+				d=r.choice(defs)
+				if c<0.25: ws.append('.%s%s'%(d,r.choice(['',':','/'])))
+				elif c<0.3: ws.append('._join(.%s%s)'%(d,r.choice(['',':','/'])))
+				elif c<0.5: ws.append('.<%s%s'%(d,r.choice(['','.(_c)','.(_e)','.(_i)','.(_s)'])))
+				elif c<0.6: ws.append('.dim=.%s'%d)
+				elif c<0.65: ws.append('.dim=(lit%d)'%i)
+				elif c<0.75 and gens: ws.append('.<%s(.%s,.%s)'%(r.choice(gens),d,name if r.random()<0.5 else d))
+				elif c<0.8 and gens: ws.append('.%s(x%d,.%s)'%(r.choice(gens),i%3,d))
+				elif c<0.85: ws.append('.-%s'%d)
+				elif c<0.9 and not ws[0].startswith('.='+d): ws.append('._adopt(.%s)'%d)
+				elif c<0.95: ws.append('._unmap(.%s,.dim)'%d)
+				else: ws.append('.+%s'%d)
+			defs.append(name)
+		lines+=[' '.join(ws),'']
+		if r.random()<0.3: lines+=[r.choice(['. anon%d .%s','. anon%d ._join(.%s)'])%(i,r.choice(defs)),'']
+	return (lines,defs)
+
+def test_random(tmp_path):
+	fn=str(tmp_path/'lazy.txt')
+	tested=0
+	for seed in range(100):
+		r=random.Random(seed)
+		(lines,defs)=gendoc(r)
+		with open(fn,'w') as f: f.write('\n'.join(lines)+'\n')
+		for name in defs: tested+=check(fn,[name])
+		tested+=check(fn,[r.choice(defs)],[r.choice(defs)])
+		tested+=check(fn,r.sample(defs,2))
+	assert tested>700
+
+def test_join(tmp_path): # ._join(.grp) joins grp like .grp does
+	fn=tmp_path/'join.txt'
+	fn.write_text('.=grp Group\n\n.grp one\n\n._join(.grp) two\n\n.=xx ._join(.grp) three\n')
+	for exports in (['grp'],['xx'],['grp','xx']): assert check(str(fn),exports)
+	assert render(str(fn),['grp'],[],True).split()==['one','two','three']
+
+def test_all(tmp_path): # (_a) and (_all) dump nodes with their uids, those need a full build
+	fn=tmp_path/'all.txt'
+	fn.write_text('.=other Other\n\n.=sup Sup\n\n.=zz .sup zed\n\n.sup one\n\n. .other two\n')
+	for exports in (['sup.(_a)'],['sup.(_all)'],['other','sup.(_a)']): assert check(str(fn),exports)
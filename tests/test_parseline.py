@@ -0,0 +1,132 @@
+# Phase0.parseline against the tokenizer it replaced, which is kept here as it was
+import glob,os,random
+import mset
+
+def old_finddotlength(l_in): # assumes l starts with .
+	if len(l_in)==1: return 1
+	if l_in[1]=='#': return len(l_in)
+	ret=1
+	l=l_in[1:]
+	pcount=0
+	while True:
+		if not l:
+			if pcount: raise ValueError("Unmatch parenthesis in %s",l_in)
+			return ret
+		c=l[0]
+		if not pcount:
+			if c in (' ','\t','\\'): return ret
+		if c=='\\':
+			if l[1] in ('(',')',):
+				ret+=2
+				l=l[2:]
+		elif c=='(': pcount+=1
+		elif c==')': pcount-=1
+		ret+=1
+		l=l[1:]
+
+def old_findwordlength(l):
+	for i,c in enumerate(l):
+		if c==' ' or c=='\t': return i
+	return len(l)
+
+def old_parseline(l):
+	dest=[]
+	inescape=False
+	while True:
+		if not l: break
+		c=l[0]
+		if c==' ' or c=='\t':
+			l=l[1:]
+			inescape=False
+			continue
+		if c=='.':
+			j=old_finddotlength(l)
+			w=l[:j]
+			if w=='.': dest.append('.')
+			elif w[1]=='#': break # ignore rest of line
+			else: dest.append(w)
+			l=l[j+1:]
+			continue
+		if c=='\\':
+			if l.startswith('\\\\') or l.startswith('\\.'): 
+				j=old_findwordlength(l)
+				dest.append(l[:j])
+				l=l[j+1:]
+				continue
+			inescape=True
+			l=l[1:]
+			if l.startswith('n'): dest.append('\\n') ; l=l[1:]
+			elif l.startswith('space'): dest.append('\\space') ; l=l[5:]
+			elif l.startswith('s'): dest.append('\\space') ; l=l[1:]
+			elif l.startswith('tab'): dest.append('\\t') ; l=l[3:]
+			elif l.startswith('t'): dest.append('\\t') ; l=l[1:]
+			elif l.startswith('bs'): dest.append('\\backspace') ; l=l[2:]
+			elif l.startswith('backspace'): dest.append('\\backspace') ; l=l[9:]
+			elif l.startswith('br'): dest.append('\\br') ; l=l[2:]
+			elif l.startswith('bold'): dest.append('\\bold') ; l=l[4:]
+			elif l.startswith('b'): dest.append('\\bold') ; l=l[1:]
+			elif l.startswith('Bold'): dest.append('\\Bold') ; l=l[4:]
+			elif l.startswith('B'): dest.append('\\Bold') ; l=l[1:]
+			elif l.startswith('italic'): dest.append('\\italic') ; l=l[6:]
+			elif l.startswith('i'): dest.append('\\italic') ; l=l[1:]
+			elif l.startswith('Italic'): dest.append('\\Italic') ; l=l[6:]
+			elif l.startswith('I'): dest.append('\\Italic') ; l=l[1:]
+			elif l.startswith('paragraph'): dest.append('\\paragraph') ; l=l[9:]
+			elif l.startswith('p'): dest.append('\\paragraph') ; l=l[1:]
+			elif l.startswith('Paragraph'): dest.append('\\Paragraph') ; l=l[9:]
+			elif l.startswith('P'): dest.append('\\Paragraph') ; l=l[1:]
+			elif l.startswith('underline'): dest.append('\\underline') ; l=l[9:]
+			elif l.startswith('u'): dest.append('\\underline') ; l=l[1:]
+			elif l.startswith('Underline'): dest.append('\\Underline') ; l=l[9:]
+			elif l.startswith('U'): dest.append('\\Underline') ; l=l[1:]
+			continue
+		if inescape:
+			for i,c in enumerate(l):
+				if c=='\\':
+					dest.append(l[:i])
+					l=l[i:]
+					break
+				if c==' ' or c=='\t':
+					inescape=False
+					dest.append(l[:i])
+					l=l[i:]
+					break
+			else:
+				dest.append(l)
+				break
+			continue
+
+		j=old_findwordlength(l)
+		dest.append(l[:j])
+		l=l[j+1:]
+	return dest
+
+def outcome(parse,l): # malformed lines only need to fail, the old parser's IndexError on a trailing \ in a dot word is now a ValueError
+	try: return ('ok',parse(l))
+	except (ValueError,IndexError): return ('err',)
+
+examples=sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'examples','*.txt')))
+
+def test_examples():
+	assert examples
+	for fn in examples:
+		with open(fn) as f:
+			for l in f:
+				l=l.rstrip('\n')
+				assert outcome(mset.Phase0.parseline,l)==outcome(old_parseline,l),(fn,l)
+
+alphabet=[' ','\t','.','\\','(',')','#','a','b','n','s','p','P','t','B','I','U','u','i','space','bold','tab','x','_','=','-','<','$',',',':','/','?']
+
+def test_random_lines():
+	r=random.Random(1)
+	for _ in range(50000):
+		l=''.join(r.choice(alphabet) for _ in range(r.randint(0,14)))
+		assert outcome(mset.Phase0.parseline,l)==outcome(old_parseline,l),repr(l)
+
+def test_offsets(): # parsing l[i:n] in place gives what parsing the slice does
+	r=random.Random(2)
+	for _ in range(5000):
+		l=''.join(r.choice(alphabet) for _ in range(r.randint(0,20)))
+		i=r.randint(0,len(l))
+		n=r.randint(i,len(l))
+		assert outcome(lambda l: mset.Phase0.parseline(l,i,n),l)==outcome(mset.Phase0.parseline,l[i:n]),(repr(l),i,n)
@@ -0,0 +1,17 @@
+# --serve: every request gets a reply, errors included, and the server goes on serving
+import os,threading,time
+import mset
+
+def test_errors_reply(tmp_path):
+	fn=tmp_path/'s.txt'
+	fn.write_text('.=top Top\n\n.=c .top C\n') # .=c makes name_cmd raise a TypeError
+	path=str(tmp_path/'s.sock')
+	threading.Thread(target=mset.Server([str(fn)]).run,args=(path,),daemon=True).start()
+	for _ in range(100):
+		if os.path.exists(path): break
+		time.sleep(0.05)
+	for _ in range(2):
+		assert 'TypeError' in mset.client(path,{'exports':['top']})['error']
+	fn.write_text('.=top Top\n\n.=cc .top C\n')
+	os.utime(str(fn),ns=(0,time.time_ns()+10**9)) # a new mtime, even on coarse clocks
+	assert mset.client(path,{'exports':['top'],'mode':'text'})['output'].split()==['C']
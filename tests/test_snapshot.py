@@ -0,0 +1,27 @@
+# --snapshot: a snapshot is only reused for the same inputs, kept chunks and globalvars
+import os
+import mset
+
+text='.=top Top\n\n.top .?-flag ._globalint(flag,1) extra text\n\n.top always\n'
+
+def render(tmp_path,vars,issnapshot):
+	fn=os.path.join(str(tmp_path),'s.txt')
+	with open(fn,'w') as f: f.write(text)
+	return mset.load([fn],vars,'text',str(tmp_path),issnapshot).render(['top'])
+
+def test_vars_drop_chunks(tmp_path):
+	for vars in ([],['flag'],[],['flag']): # each also runs after a snapshot of the other
+		assert render(tmp_path,vars,True)==render(tmp_path,vars,False)
+	assert render(tmp_path,['flag'],True).split()==['always']
+	assert len([fn for fn in os.listdir(tmp_path) if fn.endswith('.nodes')])==2
+
+def test_library_leaves_gc(tmp_path): # only main() freezes the loaded graph, load() callers may drop theirs
+	import gc
+	render(tmp_path,[],True) # writes the snapshot
+	count=gc.get_freeze_count()
+	for isgc in (True,False,True):
+		if isgc: gc.enable()
+		else: gc.disable()
+		assert render(tmp_path,[],True)==render(tmp_path,[],False)
+		assert gc.isenabled()==isgc
+	assert gc.get_freeze_count()==count
@@ -0,0 +1,39 @@
+# Suppressions.signature: equal signatures mean equal suppressed sets, so RenderCache replays are right
+import random
+import mset
+
+def test_signature():
+	r=random.Random(20)
+	s=mset.Suppressions()
+	seen={} # sig -> uids
+	marks=[]
+	for _ in range(20000):
+		op=r.randrange(4)
+		if op==0: marks.append(s.mark())
+		elif op==1 and marks: s.restore(marks.pop())
+		else: s.set(r.randrange(12),r.random()<0.6)
+		assert seen.setdefault(s.signature(),frozenset(s.uids))==s.uids
+	assert len(seen)>100
+
+text='''.=top Top
+
+.=big Big
+
+.=note Note
+
+.=hdr Header .<note
+
+.=other Other .<hdr
+
+'''+''.join('.big item%d\n\n'%i for i in range(50))+''.join(('.top ._suppress(.note) .<hdr %d ._unsuppress(.note)\n\n',
+	'.top ._suppress(.big) .<other %d .<big\n\n','.top .<hdr .<other %d\n\n')[i%3]%i for i in range(30))
+
+def test_memo(tmp_path):
+	fn=tmp_path/'s.txt'
+	fn.write_text(text)
+	doc=mset.load([str(fn)],[],'text')
+	for sup in ([],['big'],['note'],['big','note']):
+		doc.maxdepth=0
+		a=doc.render(['top'],sup)
+		doc.maxdepth=1000 # no RenderCache
+		assert a==doc.render(['top'],sup),sup
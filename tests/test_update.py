@@ -0,0 +1,59 @@
+# Nodes.update: rebuilding a document from its first changed chunk gives the same graph and output as building it afresh
+import contextlib,io,os,random,re
+import mset
+
+examples=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'examples')
+files=[('story.txt',[]),('taxes.fancy.txt',['html']),('taxes.simple.txt',[])]
+
+def phase0(text,vars):
+	p0=mset.newphase0(vars,'text')
+	p0.addchunks(text,mset.Phase0.splitchunks(text))
+	p0.process()
+	return p0
+
+def outputs(doc,names):
+	ret=[]
+	for name in names:
+		try: ret.append(doc.render([name]))
+		except mset.MsetError as e: ret.append(str(e))
+	return ret
+
+def dump(doc): # without the addresses
+	f=io.StringIO()
+	with contextlib.redirect_stdout(f): doc.nodes.nodes_dump()
+	return re.sub('object at 0x[0-9a-f]+','',f.getvalue())
+
+def mutate(r,paras):
+	paras=list(paras)
+	i=r.randrange(len(paras))
+	op=r.randrange(6)
+	if op==0: paras[i]+=' extra%d'%r.randrange(10)
+	elif op==1 and len(paras)>2: del paras[i]
+	elif op==2: paras.insert(i,paras[r.randrange(len(paras))].replace('.=','.#'))
+	elif op==3: paras.append(paras[i].replace('.=','.#')) # only adds chunks
+	elif op==4: paras[i]=paras[i].replace(' ','  ') # same words, other source lines
+	else: paras[i]=paras[i].replace('10.31','99.5').replace('Harry','Sally')
+	return paras
+
+def test_update():
+	r=random.Random(8)
+	tested=0
+	for _ in range(80):
+		(fn,vars)=r.choice(files)
+		with open(os.path.join(examples,fn)) as f: paras=f.read().rstrip('\n').split('\n\n')
+		a='\n\n'.join(mutate(r,paras) if r.random()<0.5 else paras)+'\n'
+		b='\n\n'.join(mutate(r,paras))+'\n'
+		try:
+			doc=mset.Document(mset.buildnodes(phase0(a,vars)))
+			fresh=mset.Document(mset.buildnodes(phase0(b,vars)))
+		except mset.MsetError: continue
+		for (text,fresh) in ((b,fresh),(a,mset.Document(mset.buildnodes(phase0(a,vars))))): # and back again
+			outputs(doc,[name for name in doc.nodes.nodesbyname if type(name) is str]) # export first, update has to cope with whatever that left behind
+			if not doc.nodes.update(phase0(text,vars)): break
+			names=[name for name in fresh.nodes.nodesbyname if type(name) is str and not name.startswith('_')]+['_default']
+			assert outputs(doc,names)==outputs(fresh,names),(fn,text)
+			assert [node.uid for node in doc.nodes.nodes]==[node.uid for node in fresh.nodes.nodes]
+			assert list(doc.nodes.nodesbyname)==list(fresh.nodes.nodesbyname)
+			assert dump(doc)==dump(fresh)
+			tested+=1
+	assert tested>40